@@ -0,0 +1,27 @@
+from typing import Iterable
+from entry_codec import ACTIVITY_IDS_EXPRESSION
+
+# Bit n of an entry's activity_mask is set when it includes the activity with id n.
+# Masks are stored as 64-bit integers, which bounds the usable activity ids. Entries
+# written before the mask existed get it from the activity-mask migration the server
+# runs in the background on startup (or `python migrate.py run activity-mask`).
+MAX_ACTIVITY_ID = 62
+
+# Aggregation expression computing the mask from an entry's activity ids
+ACTIVITY_MASK_EXPRESSION = {
+    "$reduce": {
+        "input": {"$setUnion": [ACTIVITY_IDS_EXPRESSION]},
+        "initialValue": 0,
+        "in": {"$add": ["$$value", {"$pow": [2, "$$this"]}]}
+    }
+}
+
+
+def mask_for_ids(activity_ids: Iterable[int]) -> int:
+    """Bitmask with the bit of each activity id set"""
+    mask = 0
+    for activity_id in activity_ids:
+        if not 0 <= activity_id <= MAX_ACTIVITY_ID:
+            raise ValueError(f"Activity id {activity_id} is outside 0-{MAX_ACTIVITY_ID}")
+        mask |= 1 << activity_id
+    return mask
@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import List, Optional
+from models import ActivityImpact
+from database import mood_entries_collection, get_activity_categories
+from activity_mask import ACTIVITY_MASK_EXPRESSION, MAX_ACTIVITY_ID
+from entry_codec import MOOD_ID_EXPRESSION
+import numpy as np
+
+# Two-sided tail probability of the 95% confidence intervals, and the matching normal quantile
+ALPHA_95 = 0.05
+Z_95 = 1.959964
+
+
+@dataclass
+class EntryArrays:
+    """Entries of one patient or cohort as column arrays"""
+    day_index: np.ndarray         # ordinal day of each entry
+    mood: np.ndarray              # mood score (mood.id) of each entry
+    activities: np.ndarray        # entries x activities boolean matrix
+    activity_ids: List[int]       # activity id of each matrix column
+
+
+async def load_entry_arrays(patient_ids: List[str], days: Optional[int] = None) -> EntryArrays:
+    """Read the entries of one or more patients into numpy arrays"""
+    categories = await get_activity_categories()
+    activity_ids = sorted(
+        activity.id
+        for category in categories
+        for activity in category.activities
+        if activity.id <= MAX_ACTIVITY_ID
+    )
+
+    day_filter = {"$exists": True}
+    if days is not None:
+        day_filter["$gte"] = (date.today() - timedelta(days=days)).toordinal()
+    pipeline = [
+        {"$match": {"patient_id": patient_ids[0] if len(patient_ids) == 1 else {"$in": patient_ids},
+                    "day_number": day_filter}},
+        # Three scalars per entry; the mask is derived on the server for entries not yet backfilled
+        {"$project": {"_id": 0, "day_number": 1, "mood": MOOD_ID_EXPRESSION,
+                      "activity_mask": {"$ifNull": ["$activity_mask", ACTIVITY_MASK_EXPRESSION]}}}
+    ]
+
+    day_index, mood, masks = [], [], []
+    async for doc in mood_entries_collection.aggregate(pipeline):
+        day_index.append(doc["day_number"])
+        mood.append(doc["mood"])
+        masks.append(int(doc["activity_mask"]))
+
+    bits = np.array(activity_ids, dtype=np.int64)
+    activities = ((np.array(masks, dtype=np.int64)[:, None] >> bits) & 1).astype(bool)
+    return EntryArrays(
+        day_index=np.array(day_index, dtype=np.int64),
+        mood=np.array(mood, dtype=float),
+        activities=activities,
+        activity_ids=activity_ids
+    )
+
+
+def t_quantile(df: np.ndarray, alpha: float = ALPHA_95, z: float = Z_95) -> np.ndarray:
+    """Student t quantile with two-sided tail probability alpha, for whole degrees of freedom >= 1
+
+    Exact for one and two degrees of freedom, Hill's approximation (Algorithm 396) above;
+    z is the normal quantile for alpha.
+    """
+    df = np.maximum(np.asarray(df, dtype=float), 1.0)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        a = 1 / (df - 0.5)
+        b = 48 / (a * a)
+        c = ((20700 * a / b - 98) * a - 16) * a + 96.36
+        d = ((94.5 / (b + c) - 3) / b + 1) * np.sqrt(a * np.pi / 2) * df
+        y = (d * alpha) ** (2 / df)
+
+        # Larger tail probabilities: expansion about the normal quantile
+        x = -z
+        c_normal = c + np.where(df < 5, 0.3 * (df - 4.5) * (x + 0.6), 0)
+        c_normal = (((0.05 * d * x - 5) * x - 7) * x - 2) * x + b + c_normal
+        y_normal = (((((0.4 * x * x + 6.3) * x * x + 36) * x * x + 94.5) / c_normal - x * x - 3) / b + 1) * x
+        y_normal = np.expm1(a * y_normal * y_normal)
+
+        y_tail = ((1 / (((df + 6) / (df * y) - 0.089 * d - 0.822) * (df + 2) * 3) + 0.5 / (df + 4))
+                  * y - 1) * (df + 1) / (df + 2) + 1 / y
+
+        t = np.sqrt(df * np.where(y > 0.05 + a, y_normal, y_tail))
+        t = np.where(df == 2, np.sqrt(2 / (alpha * (2 - alpha)) - 2), t)
+        return np.where(df == 1, 1 / np.tan(alpha * np.pi / 2), t)
+
+
+def activity_effects(mood: np.ndarray, activities: np.ndarray, alpha: float = ALPHA_95, z: float = Z_95) -> dict:
+    """Mean mood with and without each activity, their difference with a Welch confidence interval, and lift"""
+    present = activities.astype(float)
+    n = len(mood)
+    n_with = present.sum(axis=0)
+    n_without = n - n_with
+
+    sum_with = mood @ present
+    sum_squares_with = (mood ** 2) @ present
+    sum_without = mood.sum() - sum_with
+    sum_squares_without = (mood ** 2).sum() - sum_squares_with
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_with = sum_with / n_with
+        mean_without = sum_without / n_without
+        # Sample variances from the sums of squares; undefined (nan) below two entries
+        var_with = (sum_squares_with - n_with * mean_with ** 2) / (n_with - 1)
+        var_without = (sum_squares_without - n_without * mean_without ** 2) / (n_without - 1)
+        difference = mean_with - mean_without
+        se_with = np.maximum(var_with, 0) / n_with
+        se_without = np.maximum(var_without, 0) / n_without
+        standard_error = np.sqrt(se_with + se_without)
+        # Welch–Satterthwaite degrees of freedom, rounded down (conservative); few entries
+        # in either group widen the interval well beyond the normal one
+        df = np.floor((se_with + se_without) ** 2
+                      / (se_with ** 2 / (n_with - 1) + se_without ** 2 / (n_without - 1)))
+        margin = np.where(standard_error > 0, t_quantile(df, alpha, z) * standard_error, standard_error)
+        lift = mean_with / mean_without
+
+    return {
+        "days_with": n_with.astype(int),
+        "days_without": n_without.astype(int),
+        "mean_with": mean_with,
+        "mean_without": mean_without,
+        "difference": difference,
+        "lift": lift,
+        "ci_low": difference - margin,
+        "ci_high": difference + margin,
+    }
+
+
+def _finite(value: float, digits: int = 3) -> Optional[float]:
+    return round(float(value), digits) if np.isfinite(value) else None
+
+
+async def activity_impact(patient_ids: List[str], days: Optional[int] = None) -> List[ActivityImpact]:
+    """Per-activity mood effect for a patient or a pooled cohort, largest difference first"""
+    arrays = await load_entry_arrays(patient_ids, days)
+    effects = activity_effects(arrays.mood, arrays.activities)
+
+    activities = {
+        activity.id: activity
+        for category in await get_activity_categories()
+        for activity in category.activities
+    }
+    impacts = []
+    for index, activity_id in enumerate(arrays.activity_ids):
+        if effects["days_with"][index] == 0:
+            continue
+        activity = activities[activity_id]
+        impacts.append(ActivityImpact(
+            activity_id=activity_id,
+            activity_name=activity.name,
+            category=activity.category,
+            days_with=int(effects["days_with"][index]),
+            days_without=int(effects["days_without"][index]),
+            mean_with=_finite(effects["mean_with"][index]),
+            mean_without=_finite(effects["mean_without"][index]),
+            difference=_finite(effects["difference"][index]),
+            lift=_finite(effects["lift"][index]),
+            ci_low=_finite(effects["ci_low"][index]),
+            ci_high=_finite(effects["ci_high"][index])
+        ))
+
+    impacts.sort(key=lambda impact: (impact.difference is None, -(impact.difference or 0), impact.activity_name))
+    return impacts
@@ -0,0 +1,86 @@
+from typing import AsyncIterator
+from database import mood_entries_collection
+from mood_service import MoodService
+from entry_codec import reference_tables, expand_entry
+import csv
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Flush the CSV buffer to the client once it grows past this many characters
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+CSV_HEADER = ['Data', 'Umore', 'Livello_Umore', 'Emoji', 'Attività', 'Note', 'Data_Creazione']
+
+
+def _entry_row(doc: dict) -> list:
+    """Format one entry (in API shape) as a CSV row"""
+    mood = doc.get("mood", {})
+    activities_text = '; '.join(
+        f"{activity['name']} ({activity['category']})" for activity in doc.get("activities", [])
+    )
+    created_at = doc.get("created_at")
+    return [
+        doc.get("date", ""),
+        mood.get("name", ""),
+        mood.get("id", ""),
+        mood.get("emoji", ""),
+        activities_text,
+        doc.get("note", ""),
+        created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else ''
+    ]
+
+
+async def stream_mood_csv(patient_id: str = "default") -> AsyncIterator[bytes]:
+    """Yield the CSV export in chunks as entries are read from the cursor"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+
+    def drain() -> bytes:
+        data = output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate(0)
+        return data
+
+    try:
+        writer.writerow(CSV_HEADER)
+
+        moods, activities = await reference_tables()
+        cursor = mood_entries_collection.find(
+            {"patient_id": patient_id},
+            {"_id": 0, "date": 1, "mood_id": 1, "activity_ids": 1, "mood": 1, "activities": 1,
+             "note": 1, "created_at": 1}
+        ).sort("date", -1).batch_size(500)
+
+        async for doc in cursor:
+            writer.writerow(_entry_row(expand_entry(doc, moods, activities)))
+            if output.tell() >= EXPORT_CHUNK_SIZE:
+                yield drain()
+
+        statistics = await MoodService.get_statistics(patient_id)
+
+        # Add empty row
+        writer.writerow([])
+
+        # Write statistics summary
+        writer.writerow(['=== STATISTICHE RIASSUNTIVE ==='])
+        writer.writerow(['Metric', 'Valore'])
+        writer.writerow(['Entries totali', statistics.total_entries])
+        writer.writerow(['Giorni consecutivi', statistics.current_streak])
+        writer.writerow(['Umore medio', statistics.average_mood])
+        writer.writerow(['Attività più comuni', '; '.join(statistics.most_common_activities)])
+
+        # Mood distribution
+        writer.writerow([])
+        writer.writerow(['=== DISTRIBUZIONE UMORE ==='])
+        writer.writerow(['Umore', 'Conteggio'])
+        for mood, count in statistics.mood_distribution.items():
+            writer.writerow([mood, count])
+
+        yield drain()
+
+    except Exception as e:
+        # Headers are already sent, so the best we can do is end the stream and log
+        logger.error(f"Error generating CSV for patient {patient_id}: {str(e)}")
+        raise
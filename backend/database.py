@@ -1,22 +1,117 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from models import MoodLevel, ActivityCategory, Activity
 from dotenv import load_dotenv
 from pathlib import Path
+import asyncio
 import os
+import time
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Get MongoDB connection
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Track connection pool usage per server from pymongo's CMAP events"""
+    
+    def __init__(self):
+        self.servers = {}
+    
+    def _server(self, address):
+        key = f"{address[0]}:{address[1]}"
+        if key not in self.servers:
+            self.servers[key] = {
+                "open": 0, "checked_out": 0, "created": 0, "closed": 0,
+                "check_outs": 0, "check_out_failures": 0, "pool_cleared": 0
+            }
+        return self.servers[key]
+    
+    def pool_created(self, event):
+        self._server(event.address)
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        self._server(event.address)["pool_cleared"] += 1
+    
+    def pool_closed(self, event):
+        pass
+    
+    def connection_created(self, event):
+        stats = self._server(event.address)
+        stats["created"] += 1
+        stats["open"] += 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        stats = self._server(event.address)
+        stats["closed"] += 1
+        stats["open"] -= 1
+    
+    def connection_check_out_started(self, event):
+        pass
+    
+    def connection_check_out_failed(self, event):
+        self._server(event.address)["check_out_failures"] += 1
+    
+    def connection_checked_out(self, event):
+        stats = self._server(event.address)
+        stats["check_outs"] += 1
+        stats["checked_out"] += 1
+    
+    def connection_checked_in(self, event):
+        self._server(event.address)["checked_out"] -= 1
+
+def _pool_options() -> dict:
+    """Connection pool settings from the environment (unset values keep pymongo's defaults)"""
+    env_options = {
+        "maxPoolSize": 'MONGO_MAX_POOL_SIZE',
+        "minPoolSize": 'MONGO_MIN_POOL_SIZE',
+        "waitQueueTimeoutMS": 'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+        "maxIdleTimeMS": 'MONGO_MAX_IDLE_TIME_MS',
+        "serverSelectionTimeoutMS": 'MONGO_SERVER_SELECTION_TIMEOUT_MS',
+        "connectTimeoutMS": 'MONGO_CONNECT_TIMEOUT_MS',
+    }
+    return {
+        option: int(os.environ[variable])
+        for option, variable in env_options.items()
+        if os.environ.get(variable)
+    }
+
+# Get MongoDB connection. This is the only client in the process; the application
+# lifespan in server.py closes it on shutdown.
+pool_monitor = PoolStatsListener()
+pool_options = _pool_options()
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_monitor], **pool_options)
 db = client[os.environ['DB_NAME']]
 
 # Collections
 mood_entries_collection = db.mood_entries
 mood_levels_collection = db.mood_levels
 activity_categories_collection = db.activity_categories
+patient_stats_collection = db.patient_stats
+mood_entry_tombstones_collection = db.mood_entry_tombstones
+reference_meta_collection = db.reference_meta
+mood_rollups_collection = db.mood_rollups
+migration_checkpoints_collection = db.migration_checkpoints
+mood_entries_quarantine_collection = db.mood_entries_quarantine
+
+# Reference data (mood levels, activity categories) is served from memory. After the TTL
+# the cache checks the version document and reloads only if the version was bumped.
+REFERENCE_CACHE_TTL_SECONDS = float(os.environ.get('REFERENCE_CACHE_TTL_SECONDS', '300'))
+REFERENCE_VERSION_ID = "reference_data"
+
+_reference_cache = {
+    "version": None,
+    "checked_at": 0.0,
+    "mood_levels": None,
+    "activity_categories": None,
+}
+_reference_lock = asyncio.Lock()
 
 async def init_reference_data():
     """Initialize mood levels and activity categories in the database"""
@@ -102,15 +197,69 @@ async def init_reference_data():
     ]
     
     await activity_categories_collection.insert_many(activity_categories)
+    await bump_reference_version()
     print("Reference data initialized successfully")
 
 # Helper functions
+def pool_stats() -> dict:
+    """Connection pool configuration and live usage counters"""
+    return {
+        "options": pool_options,
+        "servers": pool_monitor.servers,
+    }
+
+async def _reference_version() -> int:
+    """Current version of the reference data"""
+    doc = await reference_meta_collection.find_one({"_id": REFERENCE_VERSION_ID})
+    return doc["version"] if doc else 0
+
+async def load_reference_cache():
+    """Load mood levels and activity categories into the process-local cache"""
+    version = await _reference_version()
+    mood_cursor = mood_levels_collection.find({}).sort("order", 1)
+    category_cursor = activity_categories_collection.find({}).sort("id", 1)
+    _reference_cache["mood_levels"] = [MoodLevel(**doc) async for doc in mood_cursor]
+    _reference_cache["activity_categories"] = [ActivityCategory(**doc) async for doc in category_cursor]
+    _reference_cache["version"] = version
+    _reference_cache["checked_at"] = time.monotonic()
+
+async def _ensure_reference_cache():
+    """Make sure the cache is loaded and not older than the TTL without a version check"""
+    if (_reference_cache["mood_levels"] is not None
+            and time.monotonic() - _reference_cache["checked_at"] < REFERENCE_CACHE_TTL_SECONDS):
+        return
+    
+    async with _reference_lock:
+        if (_reference_cache["mood_levels"] is not None
+                and time.monotonic() - _reference_cache["checked_at"] < REFERENCE_CACHE_TTL_SECONDS):
+            return
+        if _reference_cache["mood_levels"] is not None:
+            if await _reference_version() == _reference_cache["version"]:
+                _reference_cache["checked_at"] = time.monotonic()
+                return
+        await load_reference_cache()
+
+async def bump_reference_version():
+    """Signal that reference data changed so every process reloads its cache"""
+    await reference_meta_collection.update_one(
+        {"_id": REFERENCE_VERSION_ID},
+        {"$inc": {"version": 1}},
+        upsert=True
+    )
+    _reference_cache["mood_levels"] = None
+    _reference_cache["activity_categories"] = None
+
+async def reference_version() -> int:
+    """Version of the cached reference data"""
+    await _ensure_reference_cache()
+    return _reference_cache["version"]
+
 async def get_mood_levels():
     """Get all mood levels"""
-    cursor = mood_levels_collection.find({}).sort("order", 1)
-    return [MoodLevel(**doc) async for doc in cursor]
+    await _ensure_reference_cache()
+    return list(_reference_cache["mood_levels"])
 
 async def get_activity_categories():
     """Get all activity categories"""
-    cursor = activity_categories_collection.find({}).sort("id", 1)
-    return [ActivityCategory(**doc) async for doc in cursor]
\ No newline at end of file
+    await _ensure_reference_cache()
+    return list(_reference_cache["activity_categories"])
@@ -0,0 +1,46 @@
+from typing import List
+import numpy as np
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points are always kept. The points in between are split into
+    threshold - 2 buckets, and from each bucket the point forming the largest triangle
+    with the previously kept point and the average of the next bucket is kept, so
+    peaks and dips survive.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Bucket boundaries over the inner points 1 .. n-2, plus a last "bucket" holding the final point
+    edges = np.arange(threshold - 1) * (n - 2) // (threshold - 2) + 1
+    edges = np.append(edges, n)
+    bucket_sizes = np.diff(edges)
+    avg_x = np.add.reduceat(x, edges[:-1]) / bucket_sizes
+    avg_y = np.add.reduceat(y, edges[:-1]) / bucket_sizes
+
+    kept = np.empty(threshold, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Twice the triangle area; the constant factor does not change the argmax
+        areas = np.abs(
+            (x[a] - avg_x[bucket + 1]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y[bucket + 1] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        kept[bucket + 1] = a
+    return kept
+
+
+def downsample_trend(rows: List[dict], max_points: int, value_key: str) -> List[dict]:
+    """Keep at most max_points rows of a date-ordered trend series, preserving its shape"""
+    if len(rows) <= max_points:
+        return rows
+    # Trend dates are validated on write, so numpy can parse them directly into day counts
+    x = np.array([row["date"] for row in rows], dtype="datetime64[D]").astype(float)
+    y = np.array([row[value_key] for row in rows], dtype=float)
+    return [rows[i] for i in lttb_indices(x, y, max_points)]
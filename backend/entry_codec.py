@@ -0,0 +1,111 @@
+from typing import Dict, List, Tuple
+from models import MoodEntry, MoodEntryMood, MoodEntryActivity, MoodLevel, Activity, parse_entry_date
+from database import get_mood_levels, get_activity_categories
+
+# Entries are stored compactly, keeping only ids of reference data:
+# {
+#   id, patient_id, date, note, created_at, updated_at, version, activity_mask,
+#   day_number: int,        # ordinal of date, used for range queries and streaks
+#   mood_id: int,
+#   activity_ids: [int]
+# }
+# Names, emojis, colors, icons and categories are expanded from the cached reference
+# data on read. Entries written before this format embed full `mood` and `activities`
+# subdocuments instead; every reader accepts both shapes.
+
+# Aggregation expressions reading either shape
+MOOD_ID_EXPRESSION = {"$ifNull": ["$mood_id", "$mood.id"]}
+ACTIVITY_IDS_EXPRESSION = {"$ifNull": ["$activity_ids", {"$ifNull": ["$activities.id", []]}]}
+
+
+def entry_mood_id(doc: dict) -> int:
+    """Mood id of a stored entry in either shape"""
+    if "mood_id" in doc:
+        return doc["mood_id"]
+    return doc["mood"]["id"]
+
+
+def entry_activity_ids(doc: dict) -> List[int]:
+    """Activity ids of a stored entry in either shape"""
+    if "activity_ids" in doc:
+        return doc["activity_ids"]
+    return [activity["id"] for activity in doc.get("activities", [])]
+
+
+async def reference_tables() -> Tuple[Dict[int, MoodLevel], Dict[int, Activity]]:
+    """Mood levels and activities from the reference cache, by id"""
+    moods = {mood.id: mood for mood in await get_mood_levels()}
+    activities = {
+        activity.id: activity
+        for category in await get_activity_categories()
+        for activity in category.activities
+    }
+    return moods, activities
+
+
+def compact_mood(mood: MoodEntryMood, moods: Dict[int, MoodLevel]) -> int:
+    """Stored form of an entry's mood, rejecting ids missing from the reference data"""
+    if mood.id not in moods:
+        raise ValueError(f"Unknown mood level: {mood.id}")
+    return mood.id
+
+
+def compact_activities(activities: List[MoodEntryActivity], known: Dict[int, Activity]) -> List[int]:
+    """Stored form of an entry's activities, rejecting ids missing from the reference data"""
+    activity_ids = []
+    for activity in activities:
+        if activity.id not in known:
+            raise ValueError(f"Unknown activity: {activity.id}")
+        if activity.id not in activity_ids:
+            activity_ids.append(activity.id)
+    return activity_ids
+
+
+def compact_entry(entry: MoodEntry, moods: Dict[int, MoodLevel], activities: Dict[int, Activity]) -> dict:
+    """Stored document for a new entry"""
+    doc = entry.dict(exclude={"mood", "activities"})
+    doc["day_number"] = parse_entry_date(entry.date).toordinal()
+    doc["mood_id"] = compact_mood(entry.mood, moods)
+    doc["activity_ids"] = compact_activities(entry.activities, activities)
+    return doc
+
+
+async def encode_entry(entry: MoodEntry) -> dict:
+    """Stored document for a new entry, using the cached reference data"""
+    moods, activities = await reference_tables()
+    return compact_entry(entry, moods, activities)
+
+
+def expand_entry(doc: dict, moods: Dict[int, MoodLevel], activities: Dict[int, Activity]) -> dict:
+    """API shape of a stored entry; legacy documents keep their embedded copies"""
+    doc = dict(doc)
+    doc.pop("day_number", None)
+    if "_id" in doc:
+        doc["_id"] = str(doc["_id"])
+
+    if "mood_id" in doc:
+        mood_id = doc.pop("mood_id")
+        mood = moods.get(mood_id)
+        doc["mood"] = (
+            {"id": mood.id, "name": mood.name, "emoji": mood.emoji, "color": mood.color}
+            if mood else {"id": mood_id, "name": "", "emoji": "", "color": ""}
+        )
+    if "activity_ids" in doc:
+        doc["activities"] = [
+            activities[activity_id].dict() if activity_id in activities
+            else {"id": activity_id, "name": "", "icon": "", "category": ""}
+            for activity_id in doc.pop("activity_ids")
+        ]
+    return doc
+
+
+async def decode_entry(doc: dict) -> MoodEntry:
+    """Entry model for a stored document"""
+    moods, activities = await reference_tables()
+    return MoodEntry(**expand_entry(doc, moods, activities))
+
+
+async def decode_entries(docs: List[dict]) -> List[MoodEntry]:
+    """Entry models for stored documents, reading the reference cache once"""
+    moods, activities = await reference_tables()
+    return [MoodEntry(**expand_entry(doc, moods, activities)) for doc in docs]
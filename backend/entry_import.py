@@ -0,0 +1,210 @@
+from typing import Iterator, List, Optional, Tuple
+from datetime import datetime
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from models import MoodEntry, CreateMoodEntryRequest, ImportReport, ImportRowError
+from database import mood_entries_collection, get_mood_levels, get_activity_categories
+from patient_stats import rebuild_patient_stats
+from rollups import rebuild_rollups
+from activity_mask import mask_for_ids
+from entry_codec import reference_tables, compact_entry
+from csv_export import CSV_HEADER
+from events import publish_entry_change
+from stats_cache import stats_cache
+import csv
+import io
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Entries per insert_many call
+IMPORT_BATCH_SIZE = 1000
+
+# Cap on the number of row errors returned in the report
+MAX_REPORTED_ERRORS = 1000
+
+DUPLICATE_KEY_ERROR = 11000
+
+# "Nome attività (Categoria)" as written by the CSV export
+_activity_re = re.compile(r"^(?P<name>.*?)\s*\((?P<category>[^()]*)\)$")
+
+
+def _validation_message(error: ValidationError) -> str:
+    """Compact single-line description of a pydantic validation error"""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}"
+        for detail in error.errors()
+    )
+
+
+def _parse_created_at(value) -> Optional[datetime]:
+    """Keep the original creation time when the source provides one"""
+    if not isinstance(value, str) or not value:
+        return None
+    for parse in (lambda v: datetime.strptime(v, '%Y-%m-%d %H:%M:%S'), datetime.fromisoformat):
+        try:
+            return parse(value)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_ndjson(text: str) -> Iterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Yield (line number, request payload, error) for each non-empty NDJSON line"""
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, None, f"Invalid JSON: {e.msg}"
+            continue
+        if not isinstance(payload, dict):
+            yield line_number, None, "Expected a JSON object"
+            continue
+        yield line_number, payload, None
+
+
+async def parse_csv(text: str) -> List[Tuple[int, Optional[dict], Optional[str]]]:
+    """Convert rows in the export CSV layout into request payloads using the reference data"""
+    moods = {mood.id: mood for mood in await get_mood_levels()}
+    activities = {}
+    for category in await get_activity_categories():
+        for activity in category.activities:
+            activities[(activity.name, activity.category)] = activity
+
+    rows = []
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if header is None:
+        return rows
+    if [column.strip().lstrip("\ufeff") for column in header] != CSV_HEADER:
+        rows.append((1, None, f"Unexpected CSV header, expected: {','.join(CSV_HEADER)}"))
+        return rows
+
+    line_start = reader.line_num + 1
+    for row in reader:
+        # Quoted notes may span several lines; report the line the record starts on
+        row_number, line_start = line_start, reader.line_num + 1
+        # The export appends summary sections after an empty row
+        if not any(cell.strip() for cell in row):
+            break
+        if len(row) < len(CSV_HEADER):
+            rows.append((row_number, None, f"Expected {len(CSV_HEADER)} columns, got {len(row)}"))
+            continue
+
+        entry_date, _, mood_level, _, activities_text, note, created_at = row[:len(CSV_HEADER)]
+        try:
+            mood = moods[int(mood_level)]
+        except (ValueError, KeyError):
+            rows.append((row_number, None, f"Unknown mood level: {mood_level}"))
+            continue
+
+        entry_activities = []
+        error = None
+        for item in filter(None, (part.strip() for part in activities_text.split(";"))):
+            match = _activity_re.match(item)
+            activity = activities.get((match.group("name"), match.group("category"))) if match else None
+            if activity is None:
+                error = f"Unknown activity: {item}"
+                break
+            entry_activities.append(activity.dict())
+        if error:
+            rows.append((row_number, None, error))
+            continue
+
+        payload = {
+            "date": entry_date,
+            "mood": {"id": mood.id, "name": mood.name, "emoji": mood.emoji, "color": mood.color},
+            "activities": entry_activities,
+            "note": note,
+        }
+        if created_at:
+            payload["created_at"] = created_at
+        rows.append((row_number, payload, None))
+
+    return rows
+
+
+async def _insert_batch(batch: List[Tuple[int, dict]], report: ImportReport):
+    """Insert one batch unordered and record per-row failures"""
+    try:
+        result = await mood_entries_collection.insert_many([doc for _, doc in batch], ordered=False)
+        report.imported += len(result.inserted_ids)
+    except BulkWriteError as e:
+        report.imported += e.details.get("nInserted", 0)
+        for write_error in e.details.get("writeErrors", []):
+            row_number, doc = batch[write_error["index"]]
+            if write_error.get("code") == DUPLICATE_KEY_ERROR:
+                message = f"Entry already exists for date {doc['date']}"
+            else:
+                message = write_error.get("errmsg", "Write failed")
+            _record_error(report, row_number, message)
+
+
+def _record_error(report: ImportReport, row_number: int, message: str):
+    """Count a failed row and keep its message while under the reporting cap"""
+    report.failed += 1
+    if len(report.errors) < MAX_REPORTED_ERRORS:
+        report.errors.append(ImportRowError(row=row_number, error=message))
+
+
+async def import_entries(text: str, data_format: str, patient_id: str = "default") -> ImportReport:
+    """Validate and bulk insert entries from NDJSON or export-format CSV"""
+    if data_format == "csv":
+        rows = await parse_csv(text)
+    elif data_format == "ndjson":
+        rows = parse_ndjson(text)
+    else:
+        raise ValueError(f"Unsupported import format: {data_format}")
+
+    report = ImportReport(total_rows=0, imported=0, failed=0, errors=[])
+    moods, activities = await reference_tables()
+    batch = []
+    for row_number, payload, error in rows:
+        report.total_rows += 1
+        if error:
+            _record_error(report, row_number, error)
+            continue
+        try:
+            request = CreateMoodEntryRequest(**payload)
+        except ValidationError as e:
+            _record_error(report, row_number, _validation_message(e))
+            continue
+
+        entry = MoodEntry(
+            date=request.date,
+            mood=request.mood,
+            activities=request.activities,
+            note=request.note,
+            patient_id=patient_id
+        )
+        created_at = _parse_created_at(payload.get("created_at"))
+        if created_at:
+            entry.created_at = created_at
+        try:
+            entry_doc = compact_entry(entry, moods, activities)
+            entry_doc["activity_mask"] = mask_for_ids(entry_doc["activity_ids"])
+        except ValueError as e:
+            _record_error(report, row_number, str(e))
+            continue
+        batch.append((row_number, entry_doc))
+
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _insert_batch(batch, report)
+            batch = []
+
+    if batch:
+        await _insert_batch(batch, report)
+
+    if report.imported:
+        # One aggregation instead of a statistics update per row
+        await rebuild_patient_stats(patient_id)
+        await rebuild_rollups(patient_id)
+        await stats_cache.invalidate(patient_id)
+        publish_entry_change(patient_id, "imported", count=report.imported)
+
+    logger.info(f"Imported {report.imported} of {report.total_rows} rows for patient {patient_id}")
+    return report
@@ -0,0 +1,159 @@
+from collections import defaultdict
+from pymongo.errors import OperationFailure, PyMongoError
+from database import db
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per subscriber; a client that falls further behind loses the oldest ones
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Seconds between keep-alive comments on idle SSE connections
+KEEPALIVE_INTERVAL = 15
+
+# Seconds to wait before reopening a change stream that failed
+CHANGE_STREAM_RETRY_DELAY = 5
+
+# Collections whose changes are pushed to clients
+WATCHED_COLLECTIONS = ["mood_entries", "mood_entry_tombstones", "patient_stats"]
+
+
+class EventBroker:
+    """In-process pub/sub of per-patient events for Server-Sent Events clients"""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, patient_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[patient_id].add(queue)
+        return queue
+
+    def unsubscribe(self, patient_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(patient_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[patient_id]
+
+    def publish(self, patient_id: str, event: str, data: dict):
+        for queue in self._subscribers.get(patient_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+
+broker = EventBroker()
+
+# Set while a change stream feeds the broker; MoodService writes then stop publishing
+# directly so events are not delivered twice (and writes from other workers are seen)
+_change_stream_active = False
+_change_stream_task = None
+
+
+def publish_entry_change(patient_id: str, action: str, entry_id: str = None, date: str = None, **extra):
+    """Publish entry-changed and stats-changed after a MoodService write (in-process fallback)"""
+    if _change_stream_active:
+        return
+    broker.publish(patient_id, "entry-changed", {"action": action, "id": entry_id, "date": date, **extra})
+    broker.publish(patient_id, "stats-changed", {"patient_id": patient_id})
+
+
+def _dispatch_change(change: dict):
+    """Translate one change stream event into broker events"""
+    collection = change["ns"]["coll"]
+    operation = change["operationType"]
+    document = change.get("fullDocument")
+
+    if collection == "mood_entries" and operation in ("insert", "update", "replace") and document:
+        action = "created" if operation == "insert" else "updated"
+        broker.publish(document["patient_id"], "entry-changed",
+                       {"action": action, "id": document["id"], "date": document.get("date")})
+    elif collection == "mood_entry_tombstones" and operation == "insert" and document:
+        broker.publish(document["patient_id"], "entry-changed",
+                       {"action": "deleted", "id": document["id"], "date": document.get("date")})
+    elif collection == "patient_stats" and operation in ("insert", "update", "replace"):
+        # Every entry write bumps data_version; ignore the streak anchor follow-up updates
+        updated = change.get("updateDescription", {}).get("updatedFields", {})
+        if operation == "update" and "data_version" not in updated:
+            return
+        patient_id = change["documentKey"]["_id"]
+        broker.publish(patient_id, "stats-changed", {"patient_id": patient_id})
+
+
+async def _watch_changes():
+    """Feed the broker from a MongoDB change stream, falling back to in-process events"""
+    global _change_stream_active
+    pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+    resume_token = None
+
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                while stream.alive:
+                    change = await stream.try_next()
+                    if not _change_stream_active:
+                        # The first successful getMore proves the server supports change streams
+                        logger.info("Pushing entry and stats events from a MongoDB change stream")
+                        _change_stream_active = True
+                    resume_token = stream.resume_token
+                    if change is not None:
+                        _dispatch_change(change)
+        except OperationFailure as e:
+            _change_stream_active = False
+            if resume_token is None:
+                # Standalone servers do not support change streams
+                logger.info(f"Change streams unavailable, using in-process events: {str(e)}")
+                return
+            # The resume point may have fallen off the oplog; start a fresh stream
+            logger.error(f"Change stream failed, reopening: {str(e)}")
+            resume_token = None
+            await asyncio.sleep(CHANGE_STREAM_RETRY_DELAY)
+        except PyMongoError as e:
+            logger.error(f"Change stream interrupted, retrying: {str(e)}")
+            _change_stream_active = False
+            await asyncio.sleep(CHANGE_STREAM_RETRY_DELAY)
+
+
+def start_event_feed():
+    """Start watching for changes in the background"""
+    global _change_stream_task
+    _change_stream_task = asyncio.create_task(_watch_changes())
+
+
+async def stop_event_feed():
+    """Stop the change stream watcher"""
+    global _change_stream_active
+    if _change_stream_task is not None:
+        _change_stream_task.cancel()
+        try:
+            await _change_stream_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Change stream watcher had failed: {str(e)}")
+    _change_stream_active = False
+
+
+def _format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def event_stream(request, patient_id: str):
+    """Yield SSE frames for one patient until the client disconnects"""
+    queue = broker.subscribe(patient_id)
+    try:
+        # Ask browsers to reconnect after 5 seconds if the connection drops
+        yield "retry: 5000\n\n"
+        while not await request.is_disconnected():
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield _format_event(event, data)
+    finally:
+        broker.unsubscribe(patient_id, queue)
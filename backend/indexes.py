@@ -0,0 +1,229 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from database import db
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Tombstones of deleted entries are kept this long for delta sync clients
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', '90'))
+
+# Collections larger than this are indexed in a background task so startup is not blocked
+INDEX_BACKGROUND_THRESHOLD = int(os.environ.get('INDEX_BACKGROUND_THRESHOLD', '100000'))
+
+# Declared indexes per collection. This is the single source of truth: anything
+# found in the database but not listed here is reported as drift.
+INDEX_SPECS = {
+    "mood_entries": [
+        # One entry per patient per day; also serves find({"patient_id"}).sort("date", -1)
+        IndexModel([("patient_id", ASCENDING), ("date", DESCENDING)],
+                   name="patient_id_date_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Trend, frequency and streak reads: day ranges of one patient on the native day number
+        IndexModel([("patient_id", ASCENDING), ("day_number", ASCENDING)],
+                   name="patient_id_day_number"),
+        # Activity queries: $bitsAllSet/$bitsAnySet are checked on index keys, so only matches are fetched
+        IndexModel([("patient_id", ASCENDING), ("activity_mask", ASCENDING)],
+                   name="patient_id_activity_mask"),
+        # Delta sync: entries changed since a watermark, keyset-paged on (updated_at, id)
+        IndexModel([("patient_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)],
+                   name="patient_id_updated_at"),
+    ],
+    "mood_entry_tombstones": [
+        IndexModel([("patient_id", ASCENDING), ("deleted_at", ASCENDING), ("id", ASCENDING)],
+                   name="patient_id_deleted_at"),
+        IndexModel([("deleted_at", ASCENDING)], name="deleted_at_ttl",
+                   expireAfterSeconds=TOMBSTONE_RETENTION_DAYS * 24 * 3600),
+    ],
+    "mood_entries_quarantine": [
+        IndexModel([("patient_id", ASCENDING), ("quarantined_at", ASCENDING)],
+                   name="patient_id_quarantined_at"),
+    ],
+    "mood_rollups": [
+        # Trend charts: one patient's periods of one granularity in date order
+        IndexModel([("patient_id", ASCENDING), ("granularity", ASCENDING), ("period", ASCENDING)],
+                   name="patient_id_granularity_period", unique=True),
+    ],
+    "mood_levels": [
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "activity_categories": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+}
+
+# Indexes that writes rely on for correctness: built in the foreground even on large
+# collections, and the server does not start without them
+REQUIRED_INDEXES = {
+    # create_entry relies on it to reject a second entry for the same day
+    "mood_entries": ["patient_id_date_unique"],
+}
+
+# Indexes no query uses any more, dropped at startup so writes stop maintaining them
+RETIRED_INDEXES = {
+    # Statistics come from patient_stats; the mood_id $ifNull grouping cannot use it
+    "mood_entries": ["patient_id_mood_id"],
+}
+
+# Background build tasks by collection name (also keeps them from being garbage collected)
+_background_builds = {}
+
+# Indexes whose last build failed, by collection and index name:
+# {"error": str, "duplicates": [{<key fields>, "count": int}]}  # duplicates only for unique indexes
+_failed_builds = {}
+
+# Duplicate key groups listed per failed unique index
+DUPLICATE_SAMPLE_SIZE = 10
+
+
+def _spec_signature(keys, unique):
+    """Normalize an index definition for comparison"""
+    return (tuple((field, int(direction)) for field, direction in keys), bool(unique))
+
+
+def _declared_signatures(collection_name: str) -> dict:
+    """Map declared index names to their signature"""
+    signatures = {}
+    for model in INDEX_SPECS.get(collection_name, []):
+        document = model.document
+        signatures[document["name"]] = _spec_signature(document["key"].items(), document.get("unique"))
+    return signatures
+
+
+async def _duplicate_keys(collection_name: str, fields: list) -> list:
+    """Sample the key values shared by more than one document"""
+    pipeline = [
+        {"$group": {"_id": {field: f"${field}" for field in fields}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": DUPLICATE_SAMPLE_SIZE}
+    ]
+    return [
+        {**doc["_id"], "count": doc["count"]}
+        async for doc in db[collection_name].aggregate(pipeline, allowDiskUse=True)
+    ]
+
+
+async def _create_indexes(collection_name: str, background: bool = False, models: list = None):
+    """Create the declared indexes for one collection, each on its own so one failure blocks no other"""
+    models = INDEX_SPECS[collection_name] if models is None else models
+    failures = {}
+    for model in models:
+        document = model.document
+        if background:
+            model = IndexModel(list(document["key"].items()),
+                               **{k: v for k, v in document.items() if k != "key"},
+                               background=True)
+        try:
+            await db[collection_name].create_indexes([model])
+        except OperationFailure as e:
+            failure = {"error": str(e)}
+            if document.get("unique"):
+                # Typically existing duplicate data; list it so it can be cleaned up
+                failure["duplicates"] = await _duplicate_keys(collection_name, list(document["key"]))
+            failures[document["name"]] = failure
+            logger.error(f"Could not create index {document['name']} on {collection_name}: {str(e)}"
+                         + (f" duplicates: {failure['duplicates']}" if failure.get("duplicates") else ""))
+    previous = _failed_builds.pop(collection_name, {})
+    for model in models:
+        previous.pop(model.document["name"], None)
+    previous.update(failures)
+    if previous:
+        _failed_builds[collection_name] = previous
+    built = [model.document["name"] for model in models if model.document["name"] not in failures]
+    logger.info(f"Ensured indexes on {collection_name}: {', '.join(built)}")
+
+
+async def _drop_retired_indexes():
+    for collection_name, names in RETIRED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection_name].drop_index(name)
+                logger.info(f"Dropped retired index {name} on {collection_name}")
+
+
+async def ensure_indexes():
+    """Create all declared indexes, in the background for large collections, and drop retired ones"""
+    await _drop_retired_indexes()
+    for collection_name in INDEX_SPECS:
+        count = await db[collection_name].estimated_document_count()
+        if count > INDEX_BACKGROUND_THRESHOLD:
+            required = REQUIRED_INDEXES.get(collection_name, [])
+            models = [model for model in INDEX_SPECS[collection_name] if model.document["name"] not in required]
+            if len(models) < len(INDEX_SPECS[collection_name]):
+                await _create_indexes(collection_name, models=[
+                    model for model in INDEX_SPECS[collection_name] if model.document["name"] in required
+                ])
+            logger.info(f"Building indexes on {collection_name} ({count} documents) in the background")
+            task = asyncio.create_task(_create_indexes(collection_name, background=True, models=models))
+            _background_builds[collection_name] = task
+            task.add_done_callback(lambda _, name=collection_name: _background_builds.pop(name, None))
+        else:
+            await _create_indexes(collection_name)
+
+
+async def stop_background_builds():
+    """Stop waiting for background index builds (the server finishes them) before the client closes"""
+    for task in list(_background_builds.values()):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Background index build had failed: {str(e)}")
+
+
+async def index_drift() -> dict:
+    """Compare the indexes present in the database with the declared set"""
+    report = {}
+    for collection_name in INDEX_SPECS:
+        declared = _declared_signatures(collection_name)
+        existing = {}
+        info = await db[collection_name].index_information()
+        for name, details in info.items():
+            if name == "_id_":
+                continue
+            existing[name] = _spec_signature(details["key"], details.get("unique"))
+
+        missing = [name for name in declared if name not in existing]
+        extra = [name for name in existing if name not in declared]
+        mismatched = [
+            name for name in declared
+            if name in existing and existing[name] != declared[name]
+        ]
+        report[collection_name] = {
+            "missing": missing,
+            "extra": extra,
+            "mismatched": mismatched,
+            "building": collection_name in _background_builds,
+            "failed": _failed_builds.get(collection_name, {}),
+        }
+    return report
+
+
+async def log_index_drift():
+    """Log any difference between declared and existing indexes"""
+    report = await index_drift()
+    for collection_name, drift in report.items():
+        if drift["missing"] or drift["extra"] or drift["mismatched"]:
+            logger.warning(
+                f"Index drift on {collection_name}: missing={drift['missing']} "
+                f"extra={drift['extra']} mismatched={drift['mismatched']}"
+            )
+        if drift["failed"]:
+            logger.error(f"Failed index builds on {collection_name}: {', '.join(drift['failed'])}")
+
+
+async def require_indexes():
+    """Fail startup when an index writes rely on is missing"""
+    missing = []
+    for collection_name, names in REQUIRED_INDEXES.items():
+        info = await db[collection_name].index_information()
+        missing.extend(f"{collection_name}.{name}" for name in names if name not in info)
+    if missing:
+        raise RuntimeError(
+            f"Required indexes are missing: {', '.join(missing)}; the index build errors above list the duplicates to clean up"
+        )
@@ -0,0 +1,444 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from database import (
+    mood_entries_collection, migration_checkpoints_collection, mood_entries_quarantine_collection,
+    mood_entry_tombstones_collection
+)
+from models import parse_entry_date
+from activity_mask import mask_for_ids
+from entry_codec import entry_activity_ids, reference_tables
+from patient_stats import mark_stats_stale
+from rollups import backfill_rollups
+from stats_cache import stats_cache
+from events import publish_entry_change
+import asyncio
+import logging
+import os
+import socket
+import time
+import typer
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Migrations the server runs in the background on startup, in this order (the date sweep
+# first). Every write already stores what they add, so once completed they are skipped.
+BACKGROUND_MIGRATIONS = ["native-date", "activity-mask"]
+
+# Pace of the background migrations, in documents per second
+BACKGROUND_MIGRATION_RATE = float(os.environ.get('BACKGROUND_MIGRATION_RATE', '500'))
+
+# A run holds its migration's lease this long past its last checkpoint; a crashed
+# run's lease expires so another process can resume
+MIGRATION_LEASE_SECONDS = float(os.environ.get('MIGRATION_LEASE_SECONDS', '120'))
+
+_background_migrations_task = None
+
+# Checkpoint documents, one per migration:
+# {
+#   _id: migration name,
+#   last_id: ObjectId,                 # batches resume after this _id
+#   processed: int, modified: int,
+#   skipped: int,                      # documents the migration cannot convert
+#   remaining: int,                    # documents still unconverted when the scan ended; completed_at stays
+#                                      # unset and the next run rescans from the start
+#   quarantined: int,                  # documents moved to mood_entries_quarantine
+#   conflicts: int,                    # retries of documents a live write changed between read and update
+#   started_at: datetime, updated_at: datetime, completed_at: datetime | None,
+#   lease_owner: str, lease_until: datetime   # the one process allowed to run the migration
+# }
+#
+# Quarantined entries keep their original document (including _id) plus
+# quarantined_at and quarantine_reason, and leave a tombstone behind for delta sync.
+
+
+class MigrationLeaseError(Exception):
+    """Raised when another process holds a migration's lease"""
+
+
+@dataclass
+class Quarantine:
+    """Transform result moving a document out of mood_entries"""
+    reason: str
+
+
+@dataclass
+class Migration:
+    """A per-document change to mood_entries"""
+    name: str
+    description: str
+    query: dict  # Selects documents that still need the change
+    projection: Optional[dict]  # Fields the transform reads; None reads whole documents
+    # Returns the update for one document, None when it cannot be converted, or a Quarantine
+    transform: Callable[[dict, Tuple[dict, dict]], Union[dict, Quarantine, None]]
+    # Whether changed documents enter or leave the statistics, so their patients need a rebuild
+    affects_statistics: bool = False
+
+
+def _compact_storage(doc: dict, reference: Tuple[dict, dict]) -> Optional[dict]:
+    """Replace embedded mood and activity copies with their ids"""
+    moods, activities = reference
+    fields, removed = {}, {}
+    if "mood" in doc:
+        if "mood_id" not in doc:
+            if doc["mood"].get("id") not in moods:
+                return None
+            fields["mood_id"] = doc["mood"]["id"]
+        removed["mood"] = ""
+    if "activities" in doc:
+        if "activity_ids" not in doc:
+            activity_ids = [activity["id"] for activity in doc["activities"]]
+            if any(activity_id not in activities for activity_id in activity_ids):
+                return None
+            fields["activity_ids"] = list(dict.fromkeys(activity_ids))
+        removed["activities"] = ""
+    update = {"$unset": removed}
+    if fields:
+        update["$set"] = fields
+    return update
+
+
+def _activity_mask(doc: dict, reference: Tuple[dict, dict]) -> Optional[dict]:
+    """Set the activity bitmask"""
+    try:
+        return {"$set": {"activity_mask": mask_for_ids(entry_activity_ids(doc))}}
+    except ValueError:
+        return None
+
+
+def _version(doc: dict, reference: Tuple[dict, dict]) -> Optional[dict]:
+    """Start version counting at 1"""
+    return {"$set": {"version": 1}}
+
+
+def _native_date(doc: dict, reference: Tuple[dict, dict]) -> Union[dict, Quarantine]:
+    """Store the day number of a valid date, quarantine entries whose date was never valid"""
+    try:
+        return {"$set": {"day_number": parse_entry_date(doc.get("date")).toordinal()}}
+    except ValueError:
+        return Quarantine(f"Invalid date {doc.get('date')!r}")
+
+
+MIGRATIONS: Dict[str, Migration] = {
+    migration.name: migration
+    for migration in [
+        Migration(
+            name="compact-storage",
+            description="Store mood_id/activity_ids instead of embedded reference data copies",
+            query={"$or": [{"mood": {"$exists": True}}, {"activities": {"$exists": True}}]},
+            projection={"mood_id": 1, "mood.id": 1, "activity_ids": 1, "activities.id": 1},
+            transform=_compact_storage,
+        ),
+        Migration(
+            name="activity-mask",
+            description="Add the activity_mask bitmask",
+            query={"activity_mask": {"$exists": False}},
+            projection={"activity_ids": 1, "activities.id": 1},
+            transform=_activity_mask,
+        ),
+        Migration(
+            name="version",
+            description="Add version 1 to entries written before optimistic concurrency",
+            query={"version": {"$exists": False}},
+            projection={},
+            transform=_version,
+        ),
+        Migration(
+            name="native-date",
+            description="Add day_number, quarantining entries with malformed dates",
+            query={"day_number": {"$exists": False}},
+            projection=None,
+            transform=_native_date,
+            affects_statistics=True,
+        ),
+    ]
+}
+
+
+async def _quarantine_entries(docs: List[dict], reasons: List[str]) -> List[dict]:
+    """Move entries to mood_entries_quarantine, returning the ones removed from mood_entries"""
+    now = datetime.utcnow()
+    # Copy first: a crash in between leaves a duplicate to clean up, never a lost entry
+    await mood_entries_quarantine_collection.bulk_write([
+        ReplaceOne({"_id": doc["_id"]}, {**doc, "quarantined_at": now, "quarantine_reason": reason}, upsert=True)
+        for doc, reason in zip(docs, reasons)
+    ], ordered=False)
+
+    removed = []
+    for doc in docs:
+        result = await mood_entries_collection.delete_one({"_id": doc["_id"], "updated_at": doc.get("updated_at")})
+        if result.deleted_count:
+            removed.append(doc)
+    if removed:
+        await mood_entry_tombstones_collection.insert_many([
+            {"id": doc.get("id"), "patient_id": doc.get("patient_id"), "date": doc.get("date"), "deleted_at": now}
+            for doc in removed
+        ])
+    for doc in removed:
+        publish_entry_change(doc.get("patient_id"), "deleted", doc.get("id"), doc.get("date"))
+    return removed
+
+
+async def _acquire_lease(name: str, owner: str) -> Optional[dict]:
+    """Take a migration's lease unless another live process holds it; returns the checkpoint document"""
+    now = datetime.utcnow()
+    try:
+        return await migration_checkpoints_collection.find_one_and_update(
+            {"_id": name, "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}, {"lease_owner": owner}]},
+            {"$set": {"lease_owner": owner, "lease_until": now + timedelta(seconds=MIGRATION_LEASE_SECONDS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # The document exists and its lease is held: the upsert tried to insert a second one
+        return None
+
+
+async def _save_checkpoint(checkpoint: dict, owner: str):
+    """Store progress and extend the lease, failing if another process took the lease over"""
+    lease_until = datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+    result = await migration_checkpoints_collection.replace_one(
+        {"_id": checkpoint["_id"], "lease_owner": owner},
+        {**checkpoint, "lease_owner": owner, "lease_until": lease_until}
+    )
+    if result.matched_count == 0:
+        raise MigrationLeaseError(f"Lost the lease of migration {checkpoint['_id']}")
+
+
+async def _release_lease(name: str, owner: str):
+    await migration_checkpoints_collection.update_one(
+        {"_id": name, "lease_owner": owner},
+        {"$set": {"lease_owner": None, "lease_until": None}}
+    )
+
+
+async def run_migration(migration: Migration, batch_size: int = 500, rate: float = 1000,
+                        dry_run: bool = False, restart: bool = False, limit: Optional[int] = None) -> dict:
+    """Apply a migration in _id order, checkpointing after every batch and pacing to `rate` documents/second;
+    raises MigrationLeaseError while another process runs it"""
+    if dry_run:
+        checkpoint = None if restart else await migration_checkpoints_collection.find_one({"_id": migration.name})
+        return await _run_batches(migration, checkpoint, batch_size, rate, limit, owner=None)
+
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    checkpoint = await _acquire_lease(migration.name, owner)
+    if checkpoint is None:
+        raise MigrationLeaseError(f"Migration {migration.name} is running in another process")
+    try:
+        if restart or "processed" not in checkpoint:
+            checkpoint = None
+        return await _run_batches(migration, checkpoint, batch_size, rate, limit, owner)
+    finally:
+        await _release_lease(migration.name, owner)
+
+
+async def _run_batches(migration: Migration, checkpoint: Optional[dict], batch_size: int, rate: float,
+                       limit: Optional[int], owner: Optional[str]) -> dict:
+    """Migration loop; owner is None for a dry run, which writes nothing"""
+    dry_run = owner is None
+    if checkpoint is None:
+        checkpoint = {"_id": migration.name, "last_id": None, "processed": 0, "modified": 0,
+                      "skipped": 0, "conflicts": 0, "started_at": datetime.utcnow(), "completed_at": None}
+    checkpoint = {key: value for key, value in checkpoint.items() if key not in ("lease_owner", "lease_until")}
+    checkpoint.setdefault("quarantined", 0)
+    if checkpoint.get("remaining") and checkpoint["last_id"] is None:
+        # Rescanning for documents an earlier scan could not convert
+        checkpoint["skipped"] = 0
+
+    reference = await reference_tables()
+    # Every write sets updated_at, so matching it skips documents a live request changed meanwhile
+    projection = None
+    if migration.projection is not None:
+        projection = {**migration.projection, "updated_at": 1, "patient_id": 1}
+    started = time.monotonic()
+    handled = 0
+
+    while limit is None or handled < limit:
+        query = dict(migration.query)
+        if checkpoint["last_id"] is not None:
+            query["_id"] = {"$gt": checkpoint["last_id"]}
+        size = batch_size if limit is None else min(batch_size, limit - handled)
+        docs = await mood_entries_collection.find(query, projection).sort("_id", 1).limit(size).to_list(length=size)
+        if not docs:
+            remaining = 0
+            if checkpoint["skipped"] and not dry_run:
+                remaining = await mood_entries_collection.count_documents(migration.query)
+            checkpoint["remaining"] = remaining
+            if remaining:
+                # Unconvertible documents are left: the next run revisits them from the start
+                checkpoint["last_id"] = None
+            else:
+                checkpoint["completed_at"] = datetime.utcnow()
+            break
+
+        operations, changed, quarantined, reasons, skipped = [], [], [], [], set()
+        for doc in docs:
+            update = migration.transform(doc, reference)
+            if update is None:
+                skipped.add(doc["_id"])
+            elif isinstance(update, Quarantine):
+                quarantined.append(doc)
+                reasons.append(update.reason)
+            else:
+                operations.append(UpdateOne({"_id": doc["_id"], "updated_at": doc.get("updated_at")}, update))
+                changed.append(doc)
+
+        if operations and not dry_run:
+            result = await mood_entries_collection.bulk_write(operations, ordered=False)
+            checkpoint["modified"] += result.modified_count
+        elif operations:
+            checkpoint["modified"] += len(operations)
+
+        if quarantined and not dry_run:
+            removed = await _quarantine_entries(quarantined, reasons)
+            checkpoint["quarantined"] += len(removed)
+            changed.extend(removed)
+        elif quarantined:
+            checkpoint["quarantined"] += len(quarantined)
+
+        if migration.affects_statistics and changed and not dry_run:
+            patient_ids = list({doc["patient_id"] for doc in changed})
+            await mark_stats_stale(patient_ids)
+            for patient_id in patient_ids:
+                await stats_cache.invalidate(patient_id)
+
+        # Documents a live write changed between read and update still need the change:
+        # hold the checkpoint before the first of them so the next batch retries it
+        pending = set()
+        if not dry_run and (operations or quarantined):
+            attempted = [doc["_id"] for doc in docs if doc["_id"] not in skipped]
+            cursor = mood_entries_collection.find({**migration.query, "_id": {"$in": attempted}}, {"_id": 1})
+            pending = {doc["_id"] async for doc in cursor}
+            checkpoint["conflicts"] += len(pending)
+        done = docs
+        for index, doc in enumerate(docs):
+            if doc["_id"] in pending:
+                done = docs[:index]
+                break
+
+        checkpoint["processed"] += len(done)
+        checkpoint["skipped"] += sum(1 for doc in done if doc["_id"] in skipped)
+        if done:
+            checkpoint["last_id"] = done[-1]["_id"]
+        handled += len(docs)
+        if not dry_run:
+            checkpoint["updated_at"] = datetime.utcnow()
+            await _save_checkpoint(checkpoint, owner)
+        logger.info(f"{migration.name}: {checkpoint['processed']} processed, {checkpoint['modified']} modified")
+
+        # Stay at or below the target rate so live traffic keeps its share of the server
+        delay = handled / rate - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    if not dry_run:
+        await _save_checkpoint(checkpoint, owner)
+    return checkpoint
+
+
+async def _run_background_migration(name: str):
+    try:
+        checkpoint = await migration_checkpoints_collection.find_one({"_id": name})
+        if checkpoint and checkpoint.get("completed_at") and not checkpoint.get("remaining"):
+            # Nothing left to find; rescanning would walk every entry inserted since the last legacy one
+            return
+        checkpoint = await run_migration(MIGRATIONS[name], rate=BACKGROUND_MIGRATION_RATE)
+        if checkpoint["quarantined"]:
+            logger.warning(f"Migration {name} has quarantined {checkpoint['quarantined']} entries")
+        if checkpoint.get("remaining"):
+            logger.warning(f"Migration {name} left {checkpoint['remaining']} entries it cannot convert")
+    except MigrationLeaseError:
+        logger.info(f"Migration {name} is running in another process")
+    except Exception as e:
+        logger.error(f"Error running migration {name}: {str(e)}")
+
+
+async def _run_background_migrations():
+    for name in BACKGROUND_MIGRATIONS:
+        await _run_background_migration(name)
+
+
+def start_background_migrations():
+    """Convert legacy entries (day number, activity mask) in the background, resuming from the checkpoints"""
+    global _background_migrations_task
+    _background_migrations_task = asyncio.create_task(_run_background_migrations())
+
+
+async def stop_background_migrations():
+    """Cancel the background migrations; the lease is released before the database client closes"""
+    if _background_migrations_task is not None:
+        _background_migrations_task.cancel()
+        try:
+            await _background_migrations_task
+        except asyncio.CancelledError:
+            pass
+
+
+app = typer.Typer(help="Batched, resumable migrations of the mood_entries collection")
+
+
+def _migration(name: str) -> Migration:
+    if name not in MIGRATIONS:
+        raise typer.BadParameter(f"Unknown migration {name}, expected one of: {', '.join(MIGRATIONS)}")
+    return MIGRATIONS[name]
+
+
+@app.command("list")
+def list_migrations():
+    """Show the available migrations and their checkpoints"""
+    async def checkpoints():
+        return {doc["_id"]: doc async for doc in migration_checkpoints_collection.find({})}
+
+    saved = asyncio.run(checkpoints())
+    for migration in MIGRATIONS.values():
+        checkpoint = saved.get(migration.name)
+        if checkpoint is not None and (checkpoint.get("lease_until") or datetime.min) > datetime.utcnow():
+            status = f"running in {checkpoint['lease_owner']}"
+        elif checkpoint is None or "processed" not in checkpoint:
+            status = "not started"
+        elif checkpoint.get("completed_at"):
+            status = f"completed {checkpoint['completed_at']:%Y-%m-%d %H:%M}"
+        else:
+            status = (f"{checkpoint['remaining']} documents not converted" if checkpoint.get("remaining")
+                      else f"in progress after {checkpoint['last_id']}")
+        typer.echo(f"{migration.name:<16} {status:<40} {migration.description}")
+
+
+@app.command()
+def run(name: str = typer.Argument(..., help="Migration to apply"),
+        batch_size: int = typer.Option(500, min=1, help="Documents per bulk_write"),
+        rate: float = typer.Option(1000, min=1, help="Maximum documents per second"),
+        dry_run: bool = typer.Option(False, "--dry-run", help="Count what would change without writing"),
+        restart: bool = typer.Option(False, "--restart", help="Ignore the checkpoint and scan from the start"),
+        limit: Optional[int] = typer.Option(None, min=1, help="Stop after this many documents")):
+    """Apply a migration, resuming from its checkpoint"""
+    migration = _migration(name)
+    try:
+        checkpoint = asyncio.run(run_migration(migration, batch_size, rate, dry_run, restart, limit))
+    except MigrationLeaseError as e:
+        typer.echo(str(e), err=True)
+        raise typer.Exit(1)
+    verb = "would modify" if dry_run else "modified"
+    typer.echo(
+        f"{migration.name}: {checkpoint['processed']} processed, {checkpoint['modified']} {verb}, "
+        f"{checkpoint['skipped']} skipped, {checkpoint['quarantined']} quarantined, "
+        f"{checkpoint['conflicts']} retried after concurrent writes"
+        + ("" if checkpoint["completed_at"] else
+           f" ({checkpoint['remaining']} documents still need it, fix them and run again)"
+           if checkpoint.get("remaining") else " (not finished, run again to resume)")
+    )
+
+
+@app.command("rebuild-rollups")
+def rebuild_rollups():
+    """Rebuild the weekly and monthly rollups of every patient"""
+    count = asyncio.run(backfill_rollups())
+    typer.echo(f"Rebuilt rollups for {count} patients")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    app()
@@ -1,8 +1,20 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
-from datetime import datetime
+from datetime import date, datetime
+import re
 import uuid
 
+# Entry dates are YYYY-MM-DD strings naming a real calendar day
+DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+_date_re = re.compile(DATE_PATTERN)
+
+
+def parse_entry_date(value: str) -> date:
+    """Parse an entry date, raising ValueError unless it is a valid YYYY-MM-DD day"""
+    if not isinstance(value, str) or not _date_re.match(value):
+        raise ValueError(f"Date must be in YYYY-MM-DD format: {value!r}")
+    return date.fromisoformat(value)
+
 # Base Models
 class MoodLevel(BaseModel):
     id: int
@@ -44,6 +56,7 @@ class MoodEntry(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     patient_id: str = "default"  # For future multi-patient support
+    version: int = 1  # Incremented on every update, used for optimistic concurrency
 
 # Request/Response Models
 class CreateMoodEntryRequest(BaseModel):
@@ -52,10 +65,24 @@ class CreateMoodEntryRequest(BaseModel):
     activities: List[MoodEntryActivity] = []
     note: str = ""
 
+    @field_validator("date")
+    @classmethod
+    def validate_date(cls, value: str) -> str:
+        parse_entry_date(value)
+        return value
+
 class UpdateMoodEntryRequest(BaseModel):
     mood: Optional[MoodEntryMood] = None
     activities: Optional[List[MoodEntryActivity]] = None
     note: Optional[str] = None
+    version: Optional[int] = None  # Expected current version; If-Match takes precedence
+
+class EntryChanges(BaseModel):
+    entries: List[MoodEntry]  # Created or updated since the watermark
+    deleted: List[str]  # Ids of entries deleted since the watermark
+    watermark: str  # Pass back as `since` on the next sync
+    has_more: bool = False  # More changes are waiting; sync again right away
+    reset: bool = False  # Full snapshot: replace local state with this and the following has_more pages
 
 # Statistics Models
 class MoodStatistics(BaseModel):
@@ -74,4 +101,28 @@ class MoodTrend(BaseModel):
 class ActivityFrequency(BaseModel):
     activity_name: str
     count: int
-    percentage: float
\ No newline at end of file
+    percentage: float
+
+class ActivityImpact(BaseModel):
+    activity_id: int
+    activity_name: str
+    category: str
+    days_with: int  # Entries that include the activity
+    days_without: int
+    mean_with: Optional[float] = None  # Mean mood score on those entries
+    mean_without: Optional[float] = None
+    difference: Optional[float] = None  # mean_with - mean_without
+    lift: Optional[float] = None  # mean_with / mean_without
+    ci_low: Optional[float] = None  # 95% confidence interval of the difference
+    ci_high: Optional[float] = None
+
+# Import Models
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class ImportReport(BaseModel):
+    total_rows: int
+    imported: int
+    failed: int
+    errors: List[ImportRowError] = []
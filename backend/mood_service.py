@@ -1,28 +1,110 @@
-from typing import List, Optional
-from datetime import datetime, timedelta
-from models import MoodEntry, CreateMoodEntryRequest, UpdateMoodEntryRequest, MoodStatistics, MoodTrend, ActivityFrequency
-from database import mood_entries_collection, get_mood_levels
+from typing import List, Optional, Tuple
+from datetime import date, datetime, timedelta
+from models import (
+    MoodEntry, CreateMoodEntryRequest, UpdateMoodEntryRequest, MoodStatistics, MoodTrend, ActivityFrequency,
+    ActivityImpact, EntryChanges, parse_entry_date
+)
+from database import mood_entries_collection, mood_entry_tombstones_collection, reference_version
+from indexes import TOMBSTONE_RETENTION_DAYS
+from events import publish_entry_change
+from singleflight import coalesce
+from stats_cache import stats_cache
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from patient_stats import apply_entry_change, mark_stats_stale, get_patient_stats, get_data_version, current_streak
+from rollups import ROLLUP_GRANULARITIES, apply_rollup_change, get_rollups
+from downsample import downsample_trend
+from analytics import activity_impact
+from activity_mask import mask_for_ids
+from entry_codec import (
+    MOOD_ID_EXPRESSION, ACTIVITY_IDS_EXPRESSION, reference_tables, compact_mood, compact_activities,
+    encode_entry, decode_entry, decode_entries
+)
+import base64
+import json
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+# Changes newer than this are left for the next sync, so writes still in flight
+# (or stamped by a worker with a slightly late clock) are not skipped
+SYNC_SAFETY_LAG_SECONDS = float(os.environ.get('SYNC_SAFETY_LAG_SECONDS', '2'))
+
+# Smallest max_points accepted for trend downsampling (first, last and one point between)
+MIN_TREND_POINTS = 3
+
+# Largest page of changes returned by one delta sync call
+MAX_CHANGES_LIMIT = int(os.environ.get('MAX_CHANGES_LIMIT', '1000'))
+
+# Largest cohort pooled by the activity impact analysis
+MAX_COHORT_SIZE = int(os.environ.get('MAX_COHORT_SIZE', '50'))
+
+class VersionConflictError(Exception):
+    """Raised when a conditional update targets an outdated entry version"""
+    
+    def __init__(self, entry_id: str, expected_version: int, current_version: int):
+        super().__init__(
+            f"Entry {entry_id} is at version {current_version}, not {expected_version}"
+        )
+        self.current_version = current_version
+
+def encode_cursor(date: str, entry_id: str) -> str:
+    """Build an opaque pagination cursor from the last (date, id) of a page"""
+    payload = json.dumps([date, entry_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Parse a pagination cursor, raising ValueError if it is malformed"""
+    try:
+        date, entry_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(date, str) or not isinstance(entry_id, str):
+        raise ValueError("Invalid cursor")
+    return date, entry_id
+
+EPOCH = datetime(1970, 1, 1)
+
+def _to_millis(value: datetime) -> int:
+    """Milliseconds since the epoch for a naive UTC datetime (MongoDB date precision)"""
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+def encode_watermark(timestamp: datetime, entry_id: str = "") -> str:
+    """Build an opaque sync watermark from the last (timestamp, id) delivered"""
+    payload = json.dumps([_to_millis(timestamp), entry_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+def decode_watermark(watermark: str) -> Tuple[datetime, str]:
+    """Parse a sync watermark, raising ValueError if it is malformed"""
+    try:
+        millis, entry_id = json.loads(base64.urlsafe_b64decode(watermark.encode("ascii")))
+        return EPOCH + timedelta(milliseconds=int(millis)), str(entry_id)
+    except Exception:
+        raise ValueError("Invalid watermark")
+
+async def _patient_version(arguments: dict):
+    """Coalescing version of a read of one patient's entries; the data version is read
+    only when the caller has not passed the one it already has"""
+    if arguments["data_version"] is None:
+        arguments["data_version"], _ = await get_data_version(arguments["patient_id"])
+    return await reference_version()
+
+async def _cohort_version(arguments: dict):
+    """Coalescing version of a read pooling several patients' entries"""
+    if arguments["data_versions"] is None:
+        arguments["data_versions"] = tuple([
+            (await get_data_version(patient_id))[0] for patient_id in arguments["patient_ids"]
+        ])
+    return await reference_version()
+
 class MoodService:
     
     @staticmethod
     async def create_entry(entry_data: CreateMoodEntryRequest, patient_id: str = "default") -> MoodEntry:
         """Create a new mood entry"""
         try:
-            # Check if entry already exists for this date
-            existing_entry = await mood_entries_collection.find_one({
-                "date": entry_data.date,
-                "patient_id": patient_id
-            })
-            
-            if existing_entry:
-                raise ValueError(f"Entry already exists for date {entry_data.date}")
-            
-            # Create new entry
             entry = MoodEntry(
                 date=entry_data.date,
                 mood=entry_data.mood,
@@ -31,14 +113,21 @@ class MoodService:
                 patient_id=patient_id
             )
             
-            # Save to database
-            entry_dict = entry.dict()
-            result = await mood_entries_collection.insert_one(entry_dict)
-            entry_dict["_id"] = str(result.inserted_id)
+            # The unique (patient_id, date) index rejects a second entry for the same day
+            entry_doc = await encode_entry(entry)
+            entry_doc["activity_mask"] = mask_for_ids(entry_doc["activity_ids"])
+            await mood_entries_collection.insert_one(entry_doc)
+            await apply_entry_change(patient_id, new_doc=entry_doc)
+            await apply_rollup_change(patient_id, new_doc=entry_doc)
+            await stats_cache.invalidate(patient_id)
+            publish_entry_change(patient_id, "created", entry.id, entry.date)
             
             logger.info(f"Created mood entry for date {entry_data.date}")
-            return MoodEntry(**entry_dict)
+            # Names, emojis and icons come from the reference data, as on every later read
+            return await decode_entry(entry_doc)
             
+        except DuplicateKeyError:
+            raise ValueError(f"Entry already exists for date {entry_data.date}")
         except Exception as e:
             logger.error(f"Error creating mood entry: {str(e)}")
             raise
@@ -53,8 +142,7 @@ class MoodService:
             })
             
             if entry_doc:
-                entry_doc["_id"] = str(entry_doc["_id"])
-                return MoodEntry(**entry_doc)
+                return await decode_entry(entry_doc)
             return None
             
         except Exception as e:
@@ -64,128 +152,250 @@ class MoodService:
     @staticmethod
     async def get_all_entries(patient_id: str = "default", limit: int = 100) -> List[MoodEntry]:
         """Get all mood entries for a patient"""
+        entries, _ = await MoodService.get_entries_page(patient_id, limit)
+        return entries
+    
+    @staticmethod
+    @coalesce("get_entries_page", version=_patient_version)
+    async def get_entries_page(patient_id: str = "default", limit: int = 100,
+                               cursor: Optional[str] = None, all_activities: Tuple[int, ...] = (),
+                               any_activities: Tuple[int, ...] = (),
+                               data_version: Optional[int] = None) -> Tuple[List[MoodEntry], Optional[str]]:
+        """Get one page of mood entries (newest first) and the cursor for the next page,
+        optionally only entries with all of / any of the given activity ids"""
         try:
-            cursor = mood_entries_collection.find({
-                "patient_id": patient_id
-            }).sort("date", -1).limit(limit)
+            query = {"patient_id": patient_id}
+            if all_activities:
+                query["activity_mask"] = {"$bitsAllSet": mask_for_ids(all_activities)}
+            if any_activities:
+                query.setdefault("activity_mask", {})["$bitsAnySet"] = mask_for_ids(any_activities)
+            if cursor:
+                # Seek past the last entry of the previous page on the (patient_id, date) index
+                last_date, last_id = decode_cursor(cursor)
+                query["$or"] = [
+                    {"date": {"$lt": last_date}},
+                    {"date": last_date, "id": {"$lt": last_id}}
+                ]
+            
+            # Dates are unique per patient, so sorting on date alone is a total order
+            docs = await mood_entries_collection.find(query).sort("date", -1).limit(limit + 1).to_list(length=limit + 1)
+            
+            entries = await decode_entries(docs[:limit])
+            
+            next_cursor = None
+            if len(docs) > limit and entries:
+                next_cursor = encode_cursor(entries[-1].date, entries[-1].id)
+            
+            return entries, next_cursor
             
-            entries = []
-            async for doc in cursor:
-                doc["_id"] = str(doc["_id"])
-                entries.append(MoodEntry(**doc))
+        except Exception as e:
+            logger.error(f"Error getting all mood entries: {str(e)}")
+            raise
+    
+    @staticmethod
+    async def get_changes(patient_id: str = "default", since: Optional[str] = None,
+                          limit: int = 500) -> EntryChanges:
+        """Get entries upserted and deleted after a sync watermark, oldest change first"""
+        if not 1 <= limit <= MAX_CHANGES_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_CHANGES_LIMIT}")
+        try:
+            now = datetime.utcnow()
+            upper = now - timedelta(seconds=SYNC_SAFETY_LAG_SECONDS)
+            upper = upper.replace(microsecond=upper.microsecond // 1000 * 1000)
+            
+            reset = since is None
+            if not reset:
+                since_at, since_id = decode_watermark(since)
+                # Tombstones older than the retention window are gone; start over
+                reset = since_at < now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+            
+            entry_query = {"patient_id": patient_id, "updated_at": {"$lt": upper}}
+            if not reset:
+                entry_query["$or"] = [
+                    {"updated_at": {"$gt": since_at}},
+                    {"updated_at": since_at, "id": {"$gt": since_id}}
+                ]
+            entry_docs = await mood_entries_collection.find(entry_query).sort(
+                [("updated_at", 1), ("id", 1)]
+            ).limit(limit + 1).to_list(length=limit + 1)
+            
+            tombstone_docs = []
+            if not reset:
+                tombstone_docs = await mood_entry_tombstones_collection.find({
+                    "patient_id": patient_id,
+                    "deleted_at": {"$lt": upper},
+                    "$or": [
+                        {"deleted_at": {"$gt": since_at}},
+                        {"deleted_at": since_at, "id": {"$gt": since_id}}
+                    ]
+                }).sort([("deleted_at", 1), ("id", 1)]).limit(limit + 1).to_list(length=limit + 1)
+            
+            # Merge both streams in (timestamp, id) order and cut at the page size
+            changes = sorted(
+                [(doc["updated_at"], doc["id"], doc) for doc in entry_docs] +
+                [(doc["deleted_at"], doc["id"], None) for doc in tombstone_docs],
+                key=lambda change: (change[0], change[1])
+            )
+            has_more = len(changes) > limit
+            changes = changes[:limit]
+            
+            entry_docs, deleted = [], []
+            for _, entry_id, doc in changes:
+                if doc is None:
+                    deleted.append(entry_id)
+                else:
+                    entry_docs.append(doc)
+            entries = await decode_entries(entry_docs)
+            
+            if has_more:
+                watermark = encode_watermark(changes[-1][0], changes[-1][1])
+            else:
+                watermark = encode_watermark(upper)
             
-            return entries
+            return EntryChanges(entries=entries, deleted=deleted, watermark=watermark,
+                                has_more=has_more, reset=reset)
             
+        except ValueError:
+            raise
         except Exception as e:
-            logger.error(f"Error getting all mood entries: {str(e)}")
+            logger.error(f"Error getting entry changes: {str(e)}")
             raise
     
     @staticmethod
-    async def update_entry(entry_id: str, update_data: UpdateMoodEntryRequest) -> Optional[MoodEntry]:
-        """Update a mood entry"""
+    async def update_entry(entry_id: str, update_data: UpdateMoodEntryRequest,
+                           expected_version: Optional[int] = None) -> Optional[MoodEntry]:
+        """Update a mood entry, optionally only if it is still at expected_version"""
         try:
             update_dict = {}
+            # Embedded copies in entries written before compact storage are dropped as they are replaced
+            legacy_fields = []
+            moods, activities = await reference_tables()
             if update_data.mood is not None:
-                update_dict["mood"] = update_data.mood.dict()
+                update_dict["mood_id"] = compact_mood(update_data.mood, moods)
+                legacy_fields.append("mood")
             if update_data.activities is not None:
-                update_dict["activities"] = [activity.dict() for activity in update_data.activities]
+                update_dict["activity_ids"] = compact_activities(update_data.activities, activities)
+                update_dict["activity_mask"] = mask_for_ids(update_dict["activity_ids"])
+                legacy_fields.append("activities")
             if update_data.note is not None:
                 update_dict["note"] = update_data.note
             
             update_dict["updated_at"] = datetime.utcnow()
             
-            result = await mood_entries_collection.update_one(
-                {"id": entry_id},
-                {"$set": update_dict}
+            query = {"id": entry_id}
+            if expected_version is not None:
+                # Entries written before versioning have no field and count as version 1
+                query["version"] = {"$in": [1, None]} if expected_version == 1 else expected_version
+            
+            # One find-and-modify: the pre-image feeds the statistics deltas and, with the
+            # $set applied, is exactly the post-image. None means the entry does not exist
+            # (or is at another version); re-saving identical values is still a successful update.
+            pipeline = [{"$set": {
+                **{field: {"$literal": value} for field, value in update_dict.items()},
+                "version": {"$add": [{"$ifNull": ["$version", 1]}, 1]}
+            }}]
+            if legacy_fields:
+                pipeline.append({"$project": {field: 0 for field in legacy_fields}})
+            previous_doc = await mood_entries_collection.find_one_and_update(
+                query, pipeline, return_document=ReturnDocument.BEFORE
             )
             
-            if result.modified_count == 0:
-                return None
-            
-            # Get updated entry
-            updated_doc = await mood_entries_collection.find_one({"id": entry_id})
-            if updated_doc:
-                updated_doc["_id"] = str(updated_doc["_id"])
-                return MoodEntry(**updated_doc)
+            if previous_doc is None:
+                if expected_version is None:
+                    return None
+                return await MoodService._resolve_version_mismatch(entry_id, update_dict, expected_version)
+            
+            updated_doc = {**previous_doc, **update_dict, "version": previous_doc.get("version", 1) + 1}
+            for field in legacy_fields:
+                updated_doc.pop(field, None)
+            if "day_number" not in previous_doc:
+                # A legacy entry the date sweep has not reached: its update would make the sweep
+                # skip it, so give it its day number here and rebuild the patient's statistics
+                await MoodService._add_day_number(updated_doc)
+                await mark_stats_stale([updated_doc["patient_id"]])
+            else:
+                await apply_entry_change(updated_doc["patient_id"], previous_doc, updated_doc)
+                await apply_rollup_change(updated_doc["patient_id"], previous_doc, updated_doc)
+            await stats_cache.invalidate(updated_doc["patient_id"])
+            publish_entry_change(updated_doc["patient_id"], "updated", entry_id, updated_doc.get("date"))
             
-            return None
+            return await decode_entry(updated_doc)
             
+        except VersionConflictError:
+            raise
         except Exception as e:
             logger.error(f"Error updating mood entry {entry_id}: {str(e)}")
             raise
     
+    @staticmethod
+    async def _add_day_number(doc: dict):
+        """Store the day number of a legacy entry with a valid date; the date sweep quarantines the rest"""
+        try:
+            day_number = parse_entry_date(doc.get("date")).toordinal()
+        except ValueError:
+            return
+        await mood_entries_collection.update_one(
+            {"_id": doc["_id"], "day_number": {"$exists": False}},
+            {"$set": {"day_number": day_number}}
+        )
+        doc["day_number"] = day_number
+    
+    @staticmethod
+    async def _resolve_version_mismatch(entry_id: str, update_dict: dict, expected_version: int) -> Optional[MoodEntry]:
+        """Tell a missing entry from a version conflict after a conditional update matched nothing"""
+        current_doc = await mood_entries_collection.find_one({"id": entry_id})
+        if current_doc is None:
+            return None
+        
+        current_version = current_doc.get("version", 1)
+        # A retried request whose first attempt already applied: report success, don't write again
+        already_applied = current_version == expected_version + 1 and all(
+            current_doc.get(field) == value
+            for field, value in update_dict.items()
+            if field != "updated_at"
+        )
+        if already_applied:
+            return await decode_entry(current_doc)
+        
+        raise VersionConflictError(entry_id, expected_version, current_version)
+    
     @staticmethod
     async def delete_entry(entry_id: str) -> bool:
         """Delete a mood entry"""
         try:
-            result = await mood_entries_collection.delete_one({"id": entry_id})
-            return result.deleted_count > 0
+            deleted_doc = await mood_entries_collection.find_one_and_delete({"id": entry_id})
+            if deleted_doc is None:
+                return False
+            
+            # Leave a tombstone so delta sync clients learn about the deletion
+            await mood_entry_tombstones_collection.insert_one({
+                "id": deleted_doc["id"],
+                "patient_id": deleted_doc["patient_id"],
+                "date": deleted_doc.get("date"),
+                "deleted_at": datetime.utcnow()
+            })
+            await apply_entry_change(deleted_doc["patient_id"], old_doc=deleted_doc)
+            await apply_rollup_change(deleted_doc["patient_id"], old_doc=deleted_doc)
+            await stats_cache.invalidate(deleted_doc["patient_id"])
+            publish_entry_change(deleted_doc["patient_id"], "deleted", entry_id, deleted_doc.get("date"))
+            return True
             
         except Exception as e:
             logger.error(f"Error deleting mood entry {entry_id}: {str(e)}")
             raise
     
     @staticmethod
-    async def get_statistics(patient_id: str = "default") -> MoodStatistics:
+    async def get_data_version(patient_id: str = "default") -> Tuple[int, Optional[datetime]]:
+        """Get the version and last modification time of a patient's entries"""
+        return await get_data_version(patient_id)
+    
+    @staticmethod
+    @coalesce("get_statistics", version=_patient_version)
+    async def get_statistics(patient_id: str = "default", data_version: Optional[int] = None) -> MoodStatistics:
         """Get mood statistics for a patient"""
         try:
-            # Get all entries with date validation
-            all_entries = await MoodService.get_all_entries(patient_id)
-            
-            # Filter out entries with invalid dates
-            valid_entries = []
-            for entry in all_entries:
-                try:
-                    # Validate date format
-                    datetime.strptime(entry.date, "%Y-%m-%d")
-                    valid_entries.append(entry)
-                except ValueError:
-                    logger.warning(f"Skipping entry with invalid date format: {entry.date}")
-                    continue
-            
-            if not valid_entries:
-                return MoodStatistics(
-                    total_entries=0,
-                    current_streak=0,
-                    average_mood="N/A",
-                    most_common_activities=[],
-                    mood_distribution={}
-                )
-            
-            # Calculate statistics with valid entries only
-            total_entries = len(valid_entries)
-            
-            # Calculate current streak (consecutive days with entries)
-            current_streak = await MoodService._calculate_streak(valid_entries)
-            
-            # Calculate average mood
-            mood_scores = [entry.mood.id for entry in valid_entries]
-            avg_mood_score = sum(mood_scores) / len(mood_scores)
-            mood_levels = await get_mood_levels()
-            avg_mood = next((mood.name for mood in mood_levels if mood.id == round(avg_mood_score)), "N/A")
-            
-            # Most common activities
-            activity_counts = {}
-            for entry in valid_entries:
-                for activity in entry.activities:
-                    activity_counts[activity.name] = activity_counts.get(activity.name, 0) + 1
-            
-            most_common = sorted(activity_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-            most_common_activities = [activity[0] for activity in most_common]
-            
-            # Mood distribution
-            mood_distribution = {}
-            for entry in valid_entries:
-                mood_name = entry.mood.name
-                mood_distribution[mood_name] = mood_distribution.get(mood_name, 0) + 1
-            
-            return MoodStatistics(
-                total_entries=total_entries,
-                current_streak=current_streak,
-                average_mood=f"{avg_mood} 😊",
-                most_common_activities=most_common_activities,
-                mood_distribution=mood_distribution
-            )
+            # Not cached: it is one point read already, which a cache lookup would not save
+            return await MoodService._compute_statistics(patient_id)
             
         except Exception as e:
             logger.error(f"Error getting statistics: {str(e)}")
@@ -199,72 +409,265 @@ class MoodService:
             )
     
     @staticmethod
-    async def _calculate_streak(entries: List[MoodEntry]) -> int:
-        """Calculate consecutive days streak"""
-        if not entries:
-            return 0
+    async def _compute_statistics(patient_id: str) -> MoodStatistics:
+        """Build the statistics response from the patient statistics document"""
+        # Single point read of the incrementally maintained statistics document
+        stats = await get_patient_stats(patient_id)
+        total_entries = stats.get("total_entries", 0)
         
-        # Sort entries by date (most recent first)
-        sorted_entries = sorted(entries, key=lambda x: x.date, reverse=True)
+        if total_entries <= 0:
+            return MoodStatistics(
+                total_entries=0,
+                current_streak=0,
+                average_mood="N/A",
+                most_common_activities=[],
+                mood_distribution={}
+            )
         
-        streak = 0
-        current_date = datetime.now().date()
+        # Names come from the reference data; the stored ones cover ids it no longer has
+        moods, activities = await reference_tables()
+        mood_names = {**stats.get("mood_names", {}), **{str(mood_id): mood.name for mood_id, mood in moods.items()}}
+        activity_names = {
+            **stats.get("activity_names", {}),
+            **{str(activity_id): activity.name for activity_id, activity in activities.items()}
+        }
         
-        for entry in sorted_entries:
-            entry_date = datetime.strptime(entry.date, "%Y-%m-%d").date()
-            
-            if entry_date == current_date:
-                streak += 1
-                current_date -= timedelta(days=1)
-            elif entry_date == current_date + timedelta(days=1):
-                # Account for today not having an entry yet
-                streak += 1
-                current_date = entry_date - timedelta(days=1)
-            else:
-                break
+        # Calculate average mood
+        avg_mood_score = stats["mood_sum"] / total_entries
+        avg_mood = mood_names.get(str(round(avg_mood_score)), "N/A")
         
-        return streak
+        # Most common activities
+        activity_counts = [
+            (activity_names.get(activity_id, activity_id), count)
+            for activity_id, count in stats.get("activity_counts", {}).items()
+            if count > 0
+        ]
+        most_common = sorted(activity_counts, key=lambda x: (-x[1], x[0]))[:5]
+        most_common_activities = [activity[0] for activity in most_common]
+        
+        # Mood distribution
+        mood_distribution = {}
+        for mood_id, count in stats.get("mood_counts", {}).items():
+            if count > 0:
+                mood_name = mood_names.get(mood_id, mood_id)
+                mood_distribution[mood_name] = mood_distribution.get(mood_name, 0) + count
+        
+        return MoodStatistics(
+            total_entries=total_entries,
+            current_streak=current_streak(stats),
+            average_mood=f"{avg_mood} 😊",
+            most_common_activities=most_common_activities,
+            mood_distribution=mood_distribution
+        )
     
     @staticmethod
-    async def get_mood_trend(days: int = 90, patient_id: str = "default") -> List[dict]:
-        """Get mood trend data for the specified number of days"""
+    @coalesce("get_mood_trend", version=_patient_version)
+    async def get_mood_trend(days: int = 90, patient_id: str = "default", granularity: str = "day",
+                             max_points: Optional[int] = None, data_version: Optional[int] = None) -> List[dict]:
+        """Get mood trend data for the specified number of days, per entry or per week/month"""
+        if granularity != "day" and granularity not in ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unsupported granularity: {granularity}")
+        if max_points is not None and max_points < MIN_TREND_POINTS:
+            raise ValueError(f"max_points must be at least {MIN_TREND_POINTS}")
         try:
-            # Get all entries for the patient
-            all_entries = await MoodService.get_all_entries(patient_id)
-            
-            # Filter entries within the specified date range
-            end_date = datetime.now().date()
-            start_date = end_date - timedelta(days=days)
-            
-            # Filter and validate entries
-            valid_entries = []
-            for entry in all_entries:
-                try:
-                    entry_date = datetime.strptime(entry.date, "%Y-%m-%d").date()
-                    if start_date <= entry_date <= end_date:
-                        valid_entries.append(entry)
-                except ValueError:
-                    logger.warning(f"Skipping entry with invalid date format: {entry.date}")
-                    continue
-            
-            # Sort by date (oldest first for trend visualization)
-            valid_entries.sort(key=lambda x: x.date)
-            
-            # Format data for charting
-            trend_data = []
-            for entry in valid_entries:
-                trend_data.append({
-                    "date": entry.date,
-                    "mood_id": entry.mood.id,
-                    "mood_name": entry.mood.name,
-                    "mood_emoji": entry.mood.emoji,
-                    "mood_color": entry.mood.color,
-                    "activities_count": len(entry.activities),
-                    "note": entry.note
-                })
-            
-            return trend_data
+            params = {"days": days, "today": date.today(), "granularity": granularity,
+                      "reference_version": await reference_version()}
+            if granularity == "day":
+                compute = lambda: MoodService._compute_mood_trend(days, patient_id)
+            else:
+                compute = lambda: MoodService._compute_rollup_trend(days, patient_id, granularity)
+            trend = await stats_cache.get_or_compute(patient_id, "mood_trend", params, data_version, compute)
+            
+            if max_points is not None:
+                # Downsampling is cheap next to the query, so the full series stays the cached one
+                value_key = "mood_id" if granularity == "day" else "mood_avg"
+                trend = downsample_trend(trend, max_points, value_key)
+            return trend
             
         except Exception as e:
             logger.error(f"Error getting mood trend: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+    
+    @staticmethod
+    async def _compute_mood_trend(days: int, patient_id: str) -> List[dict]:
+        """Read the trend window from the entries"""
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=days)
+        
+        # Range scan on the (patient_id, day_number) index, projecting only the chart fields
+        pipeline = [
+            {"$match": {
+                "patient_id": patient_id,
+                "day_number": {"$gte": start_date.toordinal(), "$lte": end_date.toordinal()}
+            }},
+            {"$sort": {"day_number": 1}},
+            {"$project": {
+                "_id": 0,
+                "date": 1,
+                "mood_id": MOOD_ID_EXPRESSION,
+                "legacy_mood": "$mood",
+                "activities_count": {"$size": ACTIVITY_IDS_EXPRESSION},
+                "note": 1
+            }}
+        ]
+        
+        moods, _ = await reference_tables()
+        trend = []
+        async for doc in mood_entries_collection.aggregate(pipeline):
+            # Reference data first; embedded copies only for ids it no longer has
+            mood = moods[doc["mood_id"]].dict() if doc["mood_id"] in moods else doc.get("legacy_mood", {})
+            trend.append({
+                "date": doc["date"],
+                "mood_id": doc["mood_id"],
+                "mood_name": mood.get("name", ""),
+                "mood_emoji": mood.get("emoji", ""),
+                "mood_color": mood.get("color", ""),
+                "activities_count": doc["activities_count"],
+                "note": doc.get("note", "")
+            })
+        return trend
+    
+    @staticmethod
+    async def _compute_rollup_trend(days: int, patient_id: str, granularity: str) -> List[dict]:
+        """Read one row per week or month overlapping the trend window from the rollups"""
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=days)
+        
+        trend = []
+        for rollup in await get_rollups(patient_id, granularity, start_date, end_date):
+            scores = [int(score) for score, count in rollup.get("mood_counts", {}).items() if count > 0]
+            trend.append({
+                "date": rollup["period"],
+                "count": rollup["count"],
+                "mood_avg": round(rollup["mood_sum"] / rollup["count"], 2),
+                "mood_min": min(scores),
+                "mood_max": max(scores),
+                "activity_counts": {
+                    activity_id: count
+                    for activity_id, count in rollup.get("activity_counts", {}).items()
+                    if count > 0
+                }
+            })
+        return trend
+    
+    @staticmethod
+    @coalesce("get_activity_frequency", version=_patient_version)
+    async def get_activity_frequency(patient_id: str = "default", start_date: Optional[str] = None,
+                                     end_date: Optional[str] = None,
+                                     category: Optional[str] = None,
+                                     data_version: Optional[int] = None) -> List[ActivityFrequency]:
+        """Get how often each activity was logged, as a count and a percentage of entries"""
+        for value in (start_date, end_date):
+            if value is not None:
+                parse_entry_date(value)
+        if start_date and end_date and start_date > end_date:
+            raise ValueError("start_date must not be after end_date")
+        try:
+            params = {"start_date": start_date, "end_date": end_date, "category": category,
+                      "reference_version": await reference_version()}
+            return await stats_cache.get_or_compute(
+                patient_id, "activity_frequency", params, data_version,
+                lambda: MoodService._compute_activity_frequency(patient_id, start_date, end_date, category),
+                encode=lambda frequencies: [frequency.dict() for frequency in frequencies],
+                decode=lambda data: [ActivityFrequency(**frequency) for frequency in data]
+            )
+            
+        except Exception as e:
+            logger.error(f"Error getting activity frequency: {str(e)}")
+            raise
+    
+    @staticmethod
+    async def _compute_activity_frequency(patient_id: str, start_date: Optional[str], end_date: Optional[str],
+                                          category: Optional[str]) -> List[ActivityFrequency]:
+        """Count activities from the statistics document, or aggregate the entries when filtered"""
+        _, activities = await reference_tables()
+        if start_date is None and end_date is None and category is None:
+            stats = await get_patient_stats(patient_id)
+            total_entries = stats.get("total_entries", 0)
+            activity_names = {
+                **stats.get("activity_names", {}),
+                **{str(activity_id): activity.name for activity_id, activity in activities.items()}
+            }
+            counts = [
+                (activity_names.get(activity_id, activity_id), count)
+                for activity_id, count in stats.get("activity_counts", {}).items()
+                if count > 0
+            ]
+        else:
+            day_filter = {"$exists": True}
+            if start_date:
+                day_filter["$gte"] = parse_entry_date(start_date).toordinal()
+            if end_date:
+                day_filter["$lte"] = parse_entry_date(end_date).toordinal()
+            
+            activity_stages = [
+                {"$project": {"activity_id": ACTIVITY_IDS_EXPRESSION}},
+                {"$unwind": "$activity_id"}
+            ]
+            if category:
+                category_ids = [
+                    activity_id for activity_id, activity in activities.items()
+                    if activity.category == category
+                ]
+                activity_stages.append({"$match": {"activity_id": {"$in": category_ids}}})
+            activity_stages.append({"$group": {"_id": "$activity_id", "count": {"$sum": 1}}})
+            
+            # Range scan on the (patient_id, day_number) index; both counts in one round trip
+            pipeline = [
+                {"$match": {"patient_id": patient_id, "day_number": day_filter}},
+                {"$facet": {
+                    "total": [{"$count": "entries"}],
+                    "activities": activity_stages
+                }}
+            ]
+            results = await mood_entries_collection.aggregate(pipeline).to_list(length=1)
+            facets = results[0] if results else {}
+            total = facets.get("total") or [{"entries": 0}]
+            total_entries = total[0]["entries"]
+            counts = [
+                (activities[doc["_id"]].name if doc["_id"] in activities else str(doc["_id"]), doc["count"])
+                for doc in facets.get("activities", [])
+            ]
+        
+        if total_entries <= 0:
+            return []
+        
+        return [
+            ActivityFrequency(
+                activity_name=name,
+                count=count,
+                percentage=round(count / total_entries * 100, 1)
+            )
+            for name, count in sorted(counts, key=lambda x: (-x[1], x[0]))
+        ]
+    
+    @staticmethod
+    @coalesce("get_activity_impact", version=_cohort_version)
+    async def get_activity_impact(patient_ids: Tuple[str, ...] = ("default",),
+                                  days: Optional[int] = None,
+                                  data_versions: Optional[Tuple[int, ...]] = None) -> List[ActivityImpact]:
+        """Get the mood difference on entries with versus without each activity, for a patient or cohort"""
+        if not patient_ids:
+            raise ValueError("At least one patient id is required")
+        if len(patient_ids) > MAX_COHORT_SIZE:
+            raise ValueError(f"A cohort can have at most {MAX_COHORT_SIZE} patients")
+        if days is not None and days <= 0:
+            raise ValueError("days must be positive")
+        try:
+            if len(patient_ids) > 1:
+                # Cached results are invalidated per patient, so pooled cohorts are computed each time
+                return await activity_impact(list(patient_ids), days)
+            
+            patient_id, data_version = patient_ids[0], data_versions[0]
+            params = {"days": days, "today": date.today() if days is not None else None,
+                      "reference_version": await reference_version()}
+            return await stats_cache.get_or_compute(
+                patient_id, "activity_impact", params, data_version,
+                lambda: activity_impact([patient_id], days),
+                encode=lambda impacts: [impact.dict() for impact in impacts],
+                decode=lambda data: [ActivityImpact(**impact) for impact in data]
+            )
+            
+        except Exception as e:
+            logger.error(f"Error getting activity impact: {str(e)}")
+            raise
@@ -0,0 +1,267 @@
+from datetime import date, datetime
+from typing import List
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from database import mood_entries_collection, patient_stats_collection
+from entry_codec import MOOD_ID_EXPRESSION, entry_mood_id, entry_activity_ids
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Compare-and-set attempts of a statistics rebuild before it gives up to concurrent writes
+REBUILD_ATTEMPTS = 3
+
+# Materialized per-patient statistics document, keyed by patient_id:
+# {
+#   _id: patient_id,
+#   total_entries: int, mood_sum: int,
+#   mood_counts: {"<mood id>": int}, activity_counts: {"<activity id>": int},
+#   mood_names: {"<mood id>": str}, activity_names: {"<activity id>": str},  # from legacy embedded copies
+#   streak_start_day: int, streak_end_day: int,  # ordinal days of the newest run of consecutive entries
+#   data_version: int, updated_at: datetime,     # bumped on every entry write, used for HTTP validators
+#   stale: bool,                                 # set when an incremental update failed
+#   rollups_ready: bool                          # see rollups.py
+# }
+
+
+def _counts_toward_statistics(doc: dict) -> bool:
+    """Whether an entry document is included in the statistics (legacy rows wait for the date sweep)"""
+    return bool(doc) and isinstance(doc.get("day_number"), int)
+
+
+def _add_entry_delta(inc: dict, names: dict, doc: dict, sign: int):
+    """Accumulate the counter changes caused by adding (+1) or removing (-1) an entry"""
+    mood_id = entry_mood_id(doc)
+    inc["total_entries"] = inc.get("total_entries", 0) + sign
+    inc["mood_sum"] = inc.get("mood_sum", 0) + sign * mood_id
+    inc[f"mood_counts.{mood_id}"] = inc.get(f"mood_counts.{mood_id}", 0) + sign
+    for activity_id in entry_activity_ids(doc):
+        key = f"activity_counts.{activity_id}"
+        inc[key] = inc.get(key, 0) + sign
+    # Names are read from the reference data; keep the ones legacy entries embed as a fallback
+    if "mood" in doc:
+        names[f"mood_names.{mood_id}"] = doc["mood"]["name"]
+    for activity in doc.get("activities", []):
+        names[f"activity_names.{activity['id']}"] = activity["name"]
+
+
+async def _scan_streak_anchor(patient_id: str):
+    """Find the newest run of consecutive days by walking day numbers newest first"""
+    cursor = mood_entries_collection.find(
+        {"patient_id": patient_id, "day_number": {"$exists": True}},
+        {"_id": 0, "day_number": 1}
+    ).sort("day_number", -1)
+
+    start = end = None
+    async for doc in cursor:
+        day = doc["day_number"]
+        if end is None:
+            start = end = day
+        elif day == start - 1:
+            start = day
+        else:
+            break
+    return start, end
+
+
+async def _update_streak_anchor(patient_id: str, stats: dict, added_day: int = None, removed_day: int = None):
+    """Move the streak anchor after an entry for a new day was added or removed"""
+    start, end = stats.get("streak_start_day"), stats.get("streak_end_day")
+    anchor = None
+
+    if added_day is not None:
+        day = added_day
+        if end is None or day > end + 1:
+            anchor = (day, day)
+        elif day == end + 1:
+            anchor = (start, day)
+        elif day != start - 1:
+            return  # Older than the newest run, cannot change it
+    elif removed_day is not None:
+        if end is None or removed_day < start:
+            return
+
+    if anchor is None:
+        # The run was split or may merge with an older one
+        anchor = await _scan_streak_anchor(patient_id)
+
+    # Compare-and-set so a concurrent writer moving the anchor is not overwritten
+    result = await patient_stats_collection.update_one(
+        {"_id": patient_id, "streak_start_day": start, "streak_end_day": end},
+        {"$set": {"streak_start_day": anchor[0], "streak_end_day": anchor[1]}}
+    )
+    if result.matched_count == 0:
+        start, end = await _scan_streak_anchor(patient_id)
+        await patient_stats_collection.update_one(
+            {"_id": patient_id},
+            {"$set": {"streak_start_day": start, "streak_end_day": end}}
+        )
+
+
+async def _aggregate_patient_stats(patient_id: str) -> dict:
+    """Compute a patient's statistics fields from the raw entries"""
+    pipeline = [
+        {"$match": {"patient_id": patient_id, "day_number": {"$exists": True}}},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "count": {"$sum": 1}, "mood_sum": {"$sum": MOOD_ID_EXPRESSION}}}
+            ],
+            "moods": [
+                {"$group": {"_id": MOOD_ID_EXPRESSION, "name": {"$max": "$mood.name"}, "count": {"$sum": 1}}}
+            ],
+            "activities": [
+                # Compact entries hold ids, legacy ones subdocuments: group both by activity id
+                {"$project": {"activity": {"$ifNull": ["$activity_ids", {"$ifNull": ["$activities", []]}]}}},
+                {"$unwind": "$activity"},
+                {"$group": {
+                    "_id": {"$ifNull": ["$activity.id", "$activity"]},
+                    "name": {"$max": "$activity.name"},
+                    "count": {"$sum": 1}
+                }}
+            ]
+        }}
+    ]
+    results = await mood_entries_collection.aggregate(pipeline).to_list(length=1)
+    facets = results[0] if results else {}
+    totals = facets.get("totals") or [{"count": 0, "mood_sum": 0}]
+    start, end = await _scan_streak_anchor(patient_id)
+
+    stats = {
+        "total_entries": totals[0]["count"],
+        "mood_sum": totals[0]["mood_sum"],
+        "mood_counts": {str(doc["_id"]): doc["count"] for doc in facets.get("moods", [])},
+        "mood_names": {str(doc["_id"]): doc["name"] for doc in facets.get("moods", []) if doc.get("name")},
+        "activity_counts": {str(doc["_id"]): doc["count"] for doc in facets.get("activities", [])},
+        "activity_names": {
+            str(doc["_id"]): doc["name"] for doc in facets.get("activities", []) if doc.get("name")
+        },
+        "streak_start_day": start,
+        "streak_end_day": end,
+        "stale": False,
+    }
+    return stats
+
+
+async def rebuild_patient_stats(patient_id: str) -> dict:
+    """Recompute a patient's statistics document from the raw entries"""
+    for _ in range(REBUILD_ATTEMPTS):
+        current = await patient_stats_collection.find_one({"_id": patient_id}, {"data_version": 1})
+        # An equality on null would be copied into an upserted document and break the $inc
+        data_version = current.get("data_version") if current else None
+        version_filter = {"$exists": False} if data_version is None else data_version
+        stats = await _aggregate_patient_stats(patient_id)
+        # Compare-and-set: a write landing after the aggregation bumped data_version, and
+        # overwriting its $inc with this snapshot would lose it for good
+        try:
+            rebuilt = await patient_stats_collection.find_one_and_update(
+                {"_id": patient_id, "data_version": version_filter},
+                {
+                    "$set": stats,
+                    # Keep data_version monotonic across rebuilds so HTTP validators never repeat
+                    "$inc": {"data_version": 1},
+                    "$setOnInsert": {"updated_at": datetime.utcnow()}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The document was created meanwhile
+            rebuilt = None
+        if rebuilt is not None:
+            return rebuilt
+
+    # Writers kept racing the rebuild: leave the document stale for the next read
+    logger.warning(f"Statistics rebuild for patient {patient_id} kept conflicting with writes")
+    return await patient_stats_collection.find_one_and_update(
+        {"_id": patient_id},
+        {"$set": {"stale": True}, "$inc": {"data_version": 1}, "$setOnInsert": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _has_entries(patient_id: str) -> bool:
+    return await mood_entries_collection.find_one({"patient_id": patient_id}, {"_id": 1}) is not None
+
+
+async def get_patient_stats(patient_id: str) -> dict:
+    """Read a patient's statistics document, building it on first access; empty for unknown patients"""
+    stats = await patient_stats_collection.find_one({"_id": patient_id})
+    if stats is None and not await _has_entries(patient_id):
+        # Reads must not create documents for arbitrary ids
+        return {}
+    if stats is None or stats.get("stale"):
+        stats = await rebuild_patient_stats(patient_id)
+    return stats
+
+
+async def get_data_version(patient_id: str):
+    """Return (data_version, updated_at) for a patient's entries"""
+    stats = await patient_stats_collection.find_one(
+        {"_id": patient_id},
+        {"data_version": 1, "updated_at": 1}
+    )
+    if stats is None:
+        if not await _has_entries(patient_id):
+            return 0, None
+        stats = await rebuild_patient_stats(patient_id)
+    return stats.get("data_version", 0), stats.get("updated_at")
+
+
+async def apply_entry_change(patient_id: str, old_doc: dict = None, new_doc: dict = None):
+    """Update a patient's statistics after an entry was created, updated or deleted"""
+    try:
+        inc, fields = {}, {}
+        if _counts_toward_statistics(old_doc):
+            _add_entry_delta(inc, fields, old_doc, -1)
+        if _counts_toward_statistics(new_doc):
+            _add_entry_delta(inc, fields, new_doc, 1)
+        inc = {key: value for key, value in inc.items() if value}
+        inc["data_version"] = 1
+        fields["updated_at"] = datetime.utcnow()
+
+        before = await patient_stats_collection.find_one_and_update(
+            {"_id": patient_id},
+            {"$inc": inc, "$set": fields},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+        if before is None:
+            # First write for this patient since the document existed: include any older history
+            await rebuild_patient_stats(patient_id)
+            return
+
+        old_day = old_doc["day_number"] if _counts_toward_statistics(old_doc) else None
+        new_day = new_doc["day_number"] if _counts_toward_statistics(new_doc) else None
+        if old_day != new_day:
+            await _update_streak_anchor(patient_id, before, added_day=new_day, removed_day=old_day)
+
+    except Exception as e:
+        # Mark the document stale so the next read rebuilds it from the entries
+        logger.error(f"Error updating statistics for patient {patient_id}: {str(e)}")
+        await patient_stats_collection.update_one(
+            {"_id": patient_id},
+            {"$set": {"stale": True, "updated_at": datetime.utcnow()}, "$inc": {"data_version": 1}},
+            upsert=True
+        )
+
+
+async def mark_stats_stale(patient_ids: List[str]):
+    """Have the next read rebuild the statistics and rollups of patients whose entries changed in bulk"""
+    await patient_stats_collection.update_many(
+        {"_id": {"$in": patient_ids}},
+        {"$set": {"stale": True, "rollups_ready": False, "updated_at": datetime.utcnow()},
+         "$inc": {"data_version": 1}}
+    )
+
+
+def current_streak(stats: dict, today: date = None) -> int:
+    """Length of the newest run of consecutive days if it reaches today (or tomorrow)"""
+    start, end = stats.get("streak_start_day"), stats.get("streak_end_day")
+    if end is None:
+        return 0
+    today = (today or datetime.now().date()).toordinal()
+    if end in (today, today + 1):
+        return end - start + 1
+    return 0
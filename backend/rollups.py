@@ -0,0 +1,178 @@
+from datetime import date, datetime, timedelta
+from typing import List
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from database import mood_entries_collection, mood_rollups_collection, patient_stats_collection
+from patient_stats import _counts_toward_statistics, get_patient_stats
+from entry_codec import entry_mood_id, entry_activity_ids
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_GRANULARITIES = ("week", "month")
+
+# One process rebuilds a patient's rollups at a time; others wait this long at most
+ROLLUP_REBUILD_LEASE_SECONDS = float(os.environ.get('ROLLUP_REBUILD_LEASE_SECONDS', '30'))
+
+# Per-patient aggregate of the entries in one calendar week (Monday first) or month:
+# {
+#   patient_id: str, granularity: "week" | "month",
+#   period: "YYYY-MM-DD",                         # first day of the period
+#   count: int, mood_sum: int,
+#   mood_counts: {"<mood score>": int},           # min and max are the lowest/highest non-zero scores
+#   activity_counts: {"<activity id>": int},
+#   built_version: int                            # patient data_version of the rebuild that wrote it
+# }
+# patient_stats.rollups_ready is true once a patient's rollups were built from the entries;
+# until then (or after a failed incremental update) readers rebuild them first.
+# patient_stats.rollups_rebuild_until is the lease of the process rebuilding them.
+
+
+def period_start(day: date, granularity: str) -> date:
+    """First day of the week (Monday) or month containing a day"""
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def _add_rollup_delta(deltas: dict, doc: dict, sign: int):
+    """Accumulate per-period counter changes caused by adding (+1) or removing (-1) an entry"""
+    day = date.fromordinal(doc["day_number"])
+    mood_id = entry_mood_id(doc)
+    for granularity in ROLLUP_GRANULARITIES:
+        inc = deltas.setdefault((granularity, period_start(day, granularity).isoformat()), {})
+        inc["count"] = inc.get("count", 0) + sign
+        inc["mood_sum"] = inc.get("mood_sum", 0) + sign * mood_id
+        inc[f"mood_counts.{mood_id}"] = inc.get(f"mood_counts.{mood_id}", 0) + sign
+        for activity_id in entry_activity_ids(doc):
+            key = f"activity_counts.{activity_id}"
+            inc[key] = inc.get(key, 0) + sign
+
+
+async def apply_rollup_change(patient_id: str, old_doc: dict = None, new_doc: dict = None):
+    """Update a patient's weekly and monthly rollups after an entry was created, updated or deleted"""
+    try:
+        deltas = {}
+        if _counts_toward_statistics(old_doc):
+            _add_rollup_delta(deltas, old_doc, -1)
+        if _counts_toward_statistics(new_doc):
+            _add_rollup_delta(deltas, new_doc, 1)
+
+        operations = []
+        for (granularity, period), inc in deltas.items():
+            inc = {key: value for key, value in inc.items() if value}
+            if inc:
+                operations.append(UpdateOne(
+                    {"patient_id": patient_id, "granularity": granularity, "period": period},
+                    {"$inc": inc},
+                    upsert=True
+                ))
+        if operations:
+            await mood_rollups_collection.bulk_write(operations, ordered=False)
+
+    except Exception as e:
+        # The next trend read rebuilds the rollups from the entries
+        logger.error(f"Error updating rollups for patient {patient_id}: {str(e)}")
+        await patient_stats_collection.update_one({"_id": patient_id}, {"$set": {"rollups_ready": False}})
+
+
+async def rebuild_rollups(patient_id: str) -> bool:
+    """Recompute all of a patient's rollups from the raw entries; False if another process is rebuilding them"""
+    now = datetime.utcnow()
+    stats = await patient_stats_collection.find_one_and_update(
+        {"_id": patient_id, "$or": [{"rollups_rebuild_until": None}, {"rollups_rebuild_until": {"$lt": now}}]},
+        {"$set": {"rollups_rebuild_until": now + timedelta(seconds=ROLLUP_REBUILD_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER
+    )
+    if stats is None:
+        return False
+    # Every entry write bumps data_version before touching the rollups
+    data_version = stats.get("data_version", 0)
+    try:
+        await _write_rollups(patient_id, data_version)
+        # Ready only if no entry was written meanwhile; otherwise the next read rebuilds again
+        await patient_stats_collection.update_one(
+            {"_id": patient_id, "data_version": data_version},
+            {"$set": {"rollups_ready": True}}
+        )
+    finally:
+        await patient_stats_collection.update_one(
+            {"_id": patient_id},
+            {"$set": {"rollups_rebuild_until": None}}
+        )
+    return True
+
+
+async def _write_rollups(patient_id: str, data_version: int):
+    """Replace a patient's rollups with ones computed from the entries, period by period"""
+    cursor = mood_entries_collection.find(
+        {"patient_id": patient_id, "day_number": {"$exists": True}},
+        {"_id": 0, "day_number": 1, "mood_id": 1, "activity_ids": 1, "mood.id": 1, "activities.id": 1}
+    )
+    deltas = {}
+    async for doc in cursor:
+        if _counts_toward_statistics(doc):
+            _add_rollup_delta(deltas, doc, 1)
+
+    rollups = []
+    for (granularity, period), inc in deltas.items():
+        rollup = {"patient_id": patient_id, "granularity": granularity, "period": period,
+                  "mood_counts": {}, "activity_counts": {}, "built_version": data_version}
+        for key, value in inc.items():
+            if "." in key:
+                field, item_id = key.split(".", 1)
+                rollup[field][item_id] = value
+            else:
+                rollup[key] = value
+        rollups.append(rollup)
+
+    # Upserts keep the unique (patient, granularity, period) index satisfied and never leave
+    # the patient without rollups; periods this rebuild did not write are dropped afterwards
+    if rollups:
+        await mood_rollups_collection.bulk_write([
+            ReplaceOne(
+                {"patient_id": patient_id, "granularity": rollup["granularity"], "period": rollup["period"]},
+                rollup,
+                upsert=True
+            )
+            for rollup in rollups
+        ], ordered=False)
+    await mood_rollups_collection.delete_many({"patient_id": patient_id, "built_version": {"$ne": data_version}})
+    logger.info(f"Rebuilt {len(rollups)} rollups for patient {patient_id}")
+
+
+async def get_rollups(patient_id: str, granularity: str, start: date, end: date) -> List[dict]:
+    """Read the non-empty periods of one granularity that overlap [start, end], oldest first"""
+    stats = await get_patient_stats(patient_id)
+    if not stats:
+        return []
+    deadline = time.monotonic() + ROLLUP_REBUILD_LEASE_SECONDS
+    while not stats.get("rollups_ready") and not await rebuild_rollups(patient_id):
+        # Another request is rebuilding them: wait for it rather than racing it
+        if time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.05)
+        stats = await patient_stats_collection.find_one({"_id": patient_id}, {"rollups_ready": 1}) or {}
+
+    cursor = mood_rollups_collection.find(
+        {
+            "patient_id": patient_id,
+            "granularity": granularity,
+            "period": {"$gte": period_start(start, granularity).isoformat(), "$lte": end.isoformat()},
+            "count": {"$gt": 0}
+        },
+        {"_id": 0}
+    ).sort("period", 1)
+    return await cursor.to_list(length=None)
+
+
+async def backfill_rollups() -> int:
+    """Rebuild the rollups of every patient that has entries"""
+    patient_ids = await mood_entries_collection.distinct("patient_id")
+    for patient_id in patient_ids:
+        await get_patient_stats(patient_id)
+        await rebuild_rollups(patient_id)
+    return len(patient_ids)
+
@@ -1,30 +1,61 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response
 from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
+from contextlib import asynccontextmanager
+from datetime import date, datetime
 from typing import List, Optional
 
 # Import our models and services
 from models import (
     MoodEntry, CreateMoodEntryRequest, UpdateMoodEntryRequest,
-    MoodLevel, ActivityCategory, MoodStatistics
+    MoodLevel, ActivityCategory, MoodStatistics, ActivityFrequency, ActivityImpact, ImportReport, EntryChanges
 )
-from database import init_reference_data, get_mood_levels, get_activity_categories
-from mood_service import MoodService
+from database import (
+    client, init_reference_data, load_reference_cache, reference_version,
+    get_mood_levels, get_activity_categories, pool_stats
+)
+from mood_service import MoodService, VersionConflictError, MAX_CHANGES_LIMIT, MAX_COHORT_SIZE
+from csv_export import stream_mood_csv
+from entry_import import import_entries
+from events import start_event_feed, stop_event_feed, event_stream
+from singleflight import read_coalescer
+from stats_cache import stats_cache
+from http_cache import make_etag, etag_matches, set_cache_headers, not_modified
+from indexes import ensure_indexes, require_indexes, index_drift, log_index_drift, stop_background_builds
+from migrate import start_background_migrations, stop_background_migrations
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Prepare reference data, indexes and the event feed on startup; release them on shutdown"""
+    await init_reference_data()
+    await load_reference_cache()
+    await ensure_indexes()
+    await log_index_drift()
+    await require_indexes()
+    start_background_migrations()
+    start_event_feed()
+    yield
+    await stop_background_migrations()
+    await stop_background_builds()
+    await stop_event_feed()
+    client.close()
 
 # Create the main app without a prefix
-app = FastAPI(title="LEAF - Laboratorio di Educazione Alla Felicità")
+app = FastAPI(title="LEAF - Laboratorio di Educazione Alla Felicità", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -34,19 +65,50 @@ api_router = APIRouter(prefix="/api")
 async def root():
     return {"message": "LEAF API - Laboratorio di Educazione Alla Felicità"}
 
+@api_router.get("/health/indexes")
+async def get_index_drift():
+    """Report differences between declared and existing database indexes"""
+    try:
+        return await index_drift()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/health/db-pool")
+async def get_db_pool_stats():
+    """Report MongoDB connection pool settings and usage"""
+    return pool_stats()
+
+@api_router.get("/health/read-coalescing")
+async def get_read_coalescing_stats():
+    """Report how many read calls were executed versus shared with an identical in-flight call"""
+    return read_coalescer.snapshot()
+
+@api_router.get("/health/stats-cache")
+async def get_stats_cache_stats():
+    """Report stats cache backend, hit/miss counts and memory use"""
+    return stats_cache.snapshot()
+
 # Reference Data Endpoints
 @api_router.get("/moods", response_model=List[MoodLevel])
-async def get_moods():
+async def get_moods(request: Request, response: Response):
     """Get all available mood levels"""
     try:
+        etag = make_etag("moods", await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        set_cache_headers(response, etag)
         return await get_mood_levels()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/activity-categories", response_model=List[ActivityCategory])
-async def get_activity_categories_endpoint():
+async def get_activity_categories_endpoint(request: Request, response: Response):
     """Get all activity categories with their activities"""
     try:
+        etag = make_etag("activity-categories", await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        set_cache_headers(response, etag)
         return await get_activity_categories()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -63,10 +125,82 @@ async def create_mood_entry(entry_data: CreateMoodEntryRequest, patient_id: str
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/entries", response_model=List[MoodEntry])
-async def get_all_entries(patient_id: str = "default", limit: int = 100):
-    """Get all mood entries for a patient"""
+async def get_all_entries(request: Request, response: Response, patient_id: str = "default",
+                          limit: int = 100, cursor: Optional[str] = None):
+    """Get mood entries for a patient, newest first; pass X-Next-Cursor back as cursor for the next page"""
+    try:
+        data_version, last_modified = await MoodService.get_data_version(patient_id)
+        etag = make_etag("entries", patient_id, data_version, last_modified, limit, cursor,
+                         await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        
+        entries, next_cursor = await MoodService.get_entries_page(patient_id, limit, cursor,
+                                                                  data_version=data_version)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return entries
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/entries/import", response_model=ImportReport)
+async def import_mood_entries(request: Request, patient_id: str = "default", format: Optional[str] = None):
+    """Bulk import entries from NDJSON or CSV in the export layout (format taken from Content-Type if omitted)"""
+    try:
+        if format is None:
+            content_type = request.headers.get("content-type", "")
+            format = "csv" if "csv" in content_type else "ndjson"
+        body = await request.body()
+        return await import_entries(body.decode("utf-8-sig"), format, patient_id)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Import body must be UTF-8 encoded")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/entries/changes", response_model=EntryChanges)
+async def get_entry_changes(patient_id: str = "default", since: Optional[str] = None,
+                            limit: int = Query(500, ge=1, le=MAX_CHANGES_LIMIT)):
+    """Get entries created, updated or deleted since a sync watermark (omit since for a full snapshot)"""
     try:
-        return await MoodService.get_all_entries(patient_id, limit)
+        return await MoodService.get_changes(patient_id, since, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/entries/query", response_model=List[MoodEntry])
+async def query_entries_by_activity(request: Request, response: Response, patient_id: str = "default",
+                                    all_activities: Optional[str] = None, any_activities: Optional[str] = None,
+                                    limit: int = 100, cursor: Optional[str] = None):
+    """Get entries with all of and/or any of the given activities (comma-separated ids), newest first"""
+    try:
+        try:
+            all_ids = tuple(int(part) for part in all_activities.split(",") if part.strip()) if all_activities else ()
+            any_ids = tuple(int(part) for part in any_activities.split(",") if part.strip()) if any_activities else ()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Activity ids must be comma-separated integers")
+        
+        data_version, last_modified = await MoodService.get_data_version(patient_id)
+        etag = make_etag("entries-query", patient_id, data_version, last_modified, all_ids, any_ids, limit, cursor,
+                         await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        
+        entries, next_cursor = await MoodService.get_entries_page(patient_id, limit, cursor, all_ids, any_ids,
+                                                                  data_version=data_version)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return entries
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -84,15 +218,36 @@ async def get_entry_by_date(date: str, patient_id: str = "default"):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/entries/{entry_id}", response_model=MoodEntry)
-async def update_mood_entry(entry_id: str, update_data: UpdateMoodEntryRequest):
-    """Update an existing mood entry"""
+async def update_mood_entry(entry_id: str, update_data: UpdateMoodEntryRequest, response: Response,
+                            if_match: Optional[str] = Header(None)):
+    """Update an existing mood entry (If-Match: "<version>" or a body version makes it conditional;
+    If-Match: * updates whatever version is current)"""
     try:
-        updated_entry = await MoodService.update_entry(entry_id, update_data)
+        expected_version = update_data.version
+        if if_match:
+            tag = if_match.strip()
+            if tag == "*":
+                expected_version = None
+            elif tag.startswith("W/"):
+                # If-Match uses strong comparison, which a weak tag never passes
+                raise HTTPException(status_code=412, detail="If-Match requires a strong entity tag")
+            else:
+                try:
+                    expected_version = int(tag.strip('"'))
+                except ValueError:
+                    raise HTTPException(status_code=400, detail="If-Match must be an entry version")
+        
+        updated_entry = await MoodService.update_entry(entry_id, update_data, expected_version)
         if not updated_entry:
             raise HTTPException(status_code=404, detail=f"Entry {entry_id} not found")
+        response.headers["ETag"] = f'"{updated_entry.version}"'
         return updated_entry
     except HTTPException:
         raise
+    except VersionConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -111,18 +266,81 @@ async def delete_mood_entry(entry_id: str):
 
 # Statistics Endpoints
 @api_router.get("/stats/overview", response_model=MoodStatistics)
-async def get_mood_statistics(patient_id: str = "default"):
+async def get_mood_statistics(request: Request, response: Response, patient_id: str = "default"):
     """Get mood statistics overview for a patient"""
     try:
-        return await MoodService.get_statistics(patient_id)
+        # The streak depends on today's date and the average mood name on reference data
+        data_version, last_modified = await MoodService.get_data_version(patient_id)
+        etag = make_etag("stats", patient_id, data_version, last_modified,
+                         date.today(), await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        return await MoodService.get_statistics(patient_id, data_version=data_version)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/stats/mood-trend")
-async def get_mood_trend(days: int = 90, patient_id: str = "default"):
-    """Get mood trend data for charting (default: last 90 days / 3 months)"""
+async def get_mood_trend(request: Request, response: Response, days: int = 90, patient_id: str = "default",
+                         granularity: str = "day", max_points: Optional[int] = None):
+    """Get mood trend data for charting (default: last 90 days / 3 months); week/month return one row per period,
+    max_points downsamples the series keeping its peaks and dips"""
+    try:
+        data_version, last_modified = await MoodService.get_data_version(patient_id)
+        etag = make_etag("trend", patient_id, data_version, last_modified, days, granularity, max_points,
+                         date.today(), await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        return await MoodService.get_mood_trend(days, patient_id, granularity, max_points,
+                                                data_version=data_version)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/stats/activity-frequency", response_model=List[ActivityFrequency])
+async def get_activity_frequency(request: Request, response: Response, patient_id: str = "default",
+                                 start_date: Optional[str] = None, end_date: Optional[str] = None,
+                                 category: Optional[str] = None):
+    """Get how often each activity was logged, optionally within a date range (YYYY-MM-DD) and category"""
+    try:
+        data_version, last_modified = await MoodService.get_data_version(patient_id)
+        etag = make_etag("activity-frequency", patient_id, data_version, last_modified,
+                         start_date, end_date, category, await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        return await MoodService.get_activity_frequency(patient_id, start_date, end_date, category,
+                                                        data_version=data_version)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/stats/activity-impact", response_model=List[ActivityImpact])
+async def get_activity_impact(request: Request, response: Response, patient_id: str = "default",
+                              cohort: Optional[str] = None, days: Optional[int] = None):
+    """Get mean mood with and without each activity; cohort is a comma-separated list of patient ids to pool"""
     try:
-        return await MoodService.get_mood_trend(days, patient_id)
+        patient_ids = tuple(dict.fromkeys(
+            part.strip() for part in cohort.split(",") if part.strip()
+        )) if cohort else (patient_id,)
+        if len(patient_ids) > MAX_COHORT_SIZE:
+            raise ValueError(f"A cohort can have at most {MAX_COHORT_SIZE} patients")
+        versions = [await MoodService.get_data_version(pid) for pid in patient_ids]
+        modified = [last_modified for _, last_modified in versions if last_modified]
+        last_modified = max(modified) if modified else None
+        etag = make_etag("activity-impact", patient_ids, [version for version, _ in versions], days,
+                         date.today(), await reference_version())
+        if etag_matches(request, etag):
+            return not_modified(etag, last_modified)
+        set_cache_headers(response, etag, last_modified)
+        return await MoodService.get_activity_impact(
+            patient_ids, days, data_versions=tuple(version for version, _ in versions)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -130,72 +348,29 @@ async def get_mood_trend(days: int = 90, patient_id: str = "default"):
 async def export_mood_data_csv(patient_id: str = "default"):
     """Export all mood data and statistics as CSV"""
     try:
-        from fastapi.responses import StreamingResponse
-        import io
-        import csv
-        from datetime import datetime
-        
-        # Get all entries and statistics
-        entries = await MoodService.get_all_entries(patient_id, limit=1000)  # Get more entries for export
-        statistics = await MoodService.get_statistics(patient_id)
-        
-        # Create CSV content
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write CSV headers
-        writer.writerow([
-            'Data', 'Umore', 'Livello_Umore', 'Emoji', 'Attività', 'Note', 'Data_Creazione'
-        ])
-        
-        # Write mood entries
-        for entry in entries:
-            activities_text = '; '.join([f"{act.name} ({act.category})" for act in entry.activities])
-            writer.writerow([
-                entry.date,
-                entry.mood.name,
-                entry.mood.id,
-                entry.mood.emoji,
-                activities_text,
-                entry.note,
-                entry.created_at.strftime('%Y-%m-%d %H:%M:%S') if entry.created_at else ''
-            ])
-        
-        # Add empty row
-        writer.writerow([])
-        
-        # Write statistics summary
-        writer.writerow(['=== STATISTICHE RIASSUNTIVE ==='])
-        writer.writerow(['Metric', 'Valore'])
-        writer.writerow(['Entries totali', statistics.total_entries])
-        writer.writerow(['Giorni consecutivi', statistics.current_streak])
-        writer.writerow(['Umore medio', statistics.average_mood])
-        writer.writerow(['Attività più comuni', '; '.join(statistics.most_common_activities)])
-        
-        # Mood distribution
-        writer.writerow([])
-        writer.writerow(['=== DISTRIBUZIONE UMORE ==='])
-        writer.writerow(['Umore', 'Conteggio'])
-        for mood, count in statistics.mood_distribution.items():
-            writer.writerow([mood, count])
-        
         # Generate filename with current date
         current_date = datetime.now().strftime('%Y-%m-%d')
         filename = f"LEAF_mood_data_{current_date}.csv"
         
-        # Create response
-        output.seek(0)
-        response = StreamingResponse(
-            io.BytesIO(output.getvalue().encode('utf-8')),
+        # Rows are written as the cursor yields them, so memory stays flat for any history size
+        return StreamingResponse(
+            stream_mood_csv(patient_id),
             media_type='text/csv',
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
         
-        return response
-        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating CSV: {str(e)}")
 
+@api_router.get("/events")
+async def stream_patient_events(request: Request, patient_id: str = "default"):
+    """Server-Sent Events stream of entry-changed and stats-changed events for a patient"""
+    return StreamingResponse(
+        event_stream(request, patient_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -205,20 +380,6 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize reference data on startup"""
-    await init_reference_data()
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
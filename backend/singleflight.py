@@ -0,0 +1,55 @@
+from typing import Any, Awaitable, Callable, Hashable, Optional
+import asyncio
+import functools
+import inspect
+
+
+class SingleFlight:
+    """Share one in-flight computation between concurrent callers with the same key"""
+
+    def __init__(self):
+        self._in_flight = {}
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn() unless a call with the same key is already running, then await that one"""
+        self.stats["calls"] += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            self.stats["executed"] += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # Shield so one caller going away does not cancel the work for the others
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": len(self._in_flight)}
+
+
+read_coalescer = SingleFlight()
+
+
+def coalesce(name: str, version: Optional[Callable[[dict], Awaitable[Hashable]]] = None):
+    """Decorator: concurrent calls with identical arguments share one execution
+
+    `version` receives the call's bound arguments. It may fill in arguments the caller left
+    out (such as a data version it reads for the key), and its result joins the key, so a
+    call made after a write never shares a computation that started before it.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = (name,)
+            if version is not None:
+                key += (await version(arguments.arguments),)
+            key += tuple(arguments.arguments.items())
+            return await read_coalescer.do(key, lambda: fn(*arguments.args, **arguments.kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+from urllib.parse import urlparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# "memory" (per process), "redis" (shared between workers) or "none"
+STATS_CACHE_BACKEND = os.environ.get('STATS_CACHE_BACKEND', 'memory')
+STATS_CACHE_MAX_BYTES = int(os.environ.get('STATS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+STATS_CACHE_TTL_SECONDS = float(os.environ.get('STATS_CACHE_TTL_SECONDS', '300'))
+STATS_CACHE_REDIS_URL = os.environ.get('STATS_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# A Redis server that stops answering must not hold up the requests waiting on it
+STATS_CACHE_TIMEOUT_SECONDS = float(os.environ.get('STATS_CACHE_TIMEOUT_SECONDS', '0.5'))
+
+KEY_PREFIX = "leaf:stats"
+
+
+class MemoryCacheBackend:
+    """Process-local LRU cache bounded by the total size of the stored values"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at, patient_id)
+        self._patient_keys = {}
+
+    def _remove(self, key: str):
+        value, _, patient_id = self._entries.pop(key)
+        self.size -= len(value)
+        keys = self._patient_keys.get(patient_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._patient_keys[patient_id]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        if item[1] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return item[0]
+
+    async def set(self, patient_id: str, key: str, value: bytes, ttl: float):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + ttl, patient_id)
+        self._patient_keys.setdefault(patient_id, set()).add(key)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def invalidate(self, patient_id: str):
+        for key in list(self._patient_keys.get(patient_id, ())):
+            self._remove(key)
+
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RedisCacheBackend:
+    """Cache shared between workers, speaking the Redis protocol (RESP) over one connection"""
+
+    def __init__(self, url: str, timeout: float = STATS_CACHE_TIMEOUT_SECONDS):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(command) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for argument in command:
+            if not isinstance(argument, bytes):
+                argument = str(argument).encode("utf-8")
+            parts.append(f"${len(argument)}\r\n".encode() + argument + b"\r\n")
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode()
+        if prefix == b"-":
+            raise RedisError(payload.decode())
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.database:
+            setup.append(("SELECT", self.database))
+        if setup:
+            await self._send(setup)
+
+    async def _send(self, commands) -> list:
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        # Read every reply even after an error so the connection stays in sync
+        replies, error = [], None
+        for _ in commands:
+            try:
+                replies.append(await self._read_reply())
+            except RedisError as e:
+                error = error or e
+                replies.append(None)
+        if error:
+            raise error
+        return replies
+
+    async def _execute(self, *commands) -> list:
+        """Pipeline commands and return their replies in order, raising asyncio.TimeoutError
+        when the connection or the server does not answer within the timeout"""
+        await asyncio.wait_for(self._lock.acquire(), self.timeout)
+        try:
+            if self._writer is None:
+                await asyncio.wait_for(self._connect(), self.timeout)
+            return await asyncio.wait_for(self._send(commands), self.timeout)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            # Drop the connection (a late reply would be read as the next command's); the next call reconnects
+            if self._writer is not None:
+                self._writer.close()
+            self._reader = self._writer = None
+            raise
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _index_key(patient_id: str) -> str:
+        return f"{KEY_PREFIX}:index:{patient_id}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return (await self._execute(("GET", key)))[0]
+
+    async def set(self, patient_id: str, key: str, value: bytes, ttl: float):
+        milliseconds = int(ttl * 1000)
+        index_key = self._index_key(patient_id)
+        await self._execute(
+            ("SET", key, value, "PX", milliseconds),
+            ("SADD", index_key, key),
+            ("PEXPIRE", index_key, milliseconds)
+        )
+
+    async def invalidate(self, patient_id: str):
+        index_key = self._index_key(patient_id)
+        keys = (await self._execute(("SMEMBERS", index_key)))[0] or []
+        await self._execute(("DEL", index_key, *keys))
+
+
+class StatsCache:
+    """Read-through cache for per-patient results keyed by (patient, name, params, data version)"""
+
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    @staticmethod
+    def _key(patient_id: str, name: str, params: dict, data_version: int) -> str:
+        encoded_params = json.dumps(params, sort_keys=True, default=str, separators=(",", ":"))
+        return f"{KEY_PREFIX}:{patient_id}:{name}:{data_version}:{encoded_params}"
+
+    async def get_or_compute(self, patient_id: str, name: str, params: dict, data_version: int,
+                             compute: Callable[[], Awaitable[Any]],
+                             encode: Callable[[Any], Any] = lambda value: value,
+                             decode: Callable[[Any], Any] = lambda value: value) -> Any:
+        """Return the cached result or compute and store it; cache failures fall back to computing"""
+        if self.backend is None:
+            return await compute()
+
+        key = self._key(patient_id, name, params, data_version)
+        try:
+            cached = await self.backend.get(key)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Stats cache read failed: {str(e)}")
+            cached = None
+        if cached is not None:
+            self.stats["hits"] += 1
+            return decode(json.loads(cached))
+
+        self.stats["misses"] += 1
+        value = await compute()
+        try:
+            payload = json.dumps(encode(value), default=str).encode("utf-8")
+            await self.backend.set(patient_id, key, payload, self.ttl)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Stats cache write failed: {str(e)}")
+        return value
+
+    async def invalidate(self, patient_id: str):
+        """Drop every cached result for a patient after a write"""
+        if self.backend is None:
+            return
+        try:
+            await self.backend.invalidate(patient_id)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Stats cache invalidation failed: {str(e)}")
+
+    def snapshot(self) -> dict:
+        snapshot = {"backend": STATS_CACHE_BACKEND, **self.stats}
+        if isinstance(self.backend, MemoryCacheBackend):
+            snapshot["bytes"] = self.backend.size
+            snapshot["max_bytes"] = self.backend.max_bytes
+        return snapshot
+
+
+def _create_backend():
+    if STATS_CACHE_BACKEND == "redis":
+        return RedisCacheBackend(STATS_CACHE_REDIS_URL)
+    if STATS_CACHE_BACKEND == "memory":
+        return MemoryCacheBackend(STATS_CACHE_MAX_BYTES)
+    return None
+
+
+stats_cache = StatsCache(_create_backend(), STATS_CACHE_TTL_SECONDS)
@@ -9,6 +9,9 @@ const MoodChart = () => {
   const [error, setError] = useState(null);
   const [selectedPeriod, setSelectedPeriod] = useState(90); // Default 3 months
 
+  // The chart cannot show more points than this legibly; the server downsamples longer periods
+  const MAX_CHART_POINTS = 200;
+
   // Period options
   const periodOptions = [
     { value: 30, label: '30 giorni' },
@@ -27,7 +30,7 @@ const MoodChart = () => {
       setLoading(true);
       setError(null);
       
-      const data = await ApiService.getMoodTrend(selectedPeriod);
+      const data = await ApiService.getMoodTrend(selectedPeriod, 'default', 'day', MAX_CHART_POINTS);
       
       // Transform data for chart
       const formattedData = data.map(entry => ({
@@ -73,6 +73,64 @@ class ApiService {
     }
   }
 
+  // Keyset pagination: pass the returned nextCursor to fetch the following (older) page
+  static async getEntriesPage(cursor = null, patientId = 'default', limit = 100) {
+    try {
+      const params = { patient_id: patientId, limit };
+      if (cursor) {
+        params.cursor = cursor;
+      }
+      const response = await apiClient.get('/entries', { params });
+      return {
+        entries: response.data,
+        nextCursor: response.headers['x-next-cursor'] || null
+      };
+    } catch (error) {
+      console.error('Error fetching entries page:', error);
+      throw error;
+    }
+  }
+
+  // Delta sync: omit since for a full snapshot, then pass back the returned watermark
+  static async getEntryChanges(since = null, patientId = 'default') {
+    try {
+      const params = { patient_id: patientId };
+      if (since) {
+        params.since = since;
+      }
+      const response = await apiClient.get('/entries/changes', { params });
+      return response.data;
+    } catch (error) {
+      console.error('Error fetching entry changes:', error);
+      throw error;
+    }
+  }
+
+  // Entries that include every id in allActivities and at least one id in anyActivities
+  static async queryEntriesByActivity({ allActivities = [], anyActivities = [] } = {}, patientId = 'default',
+                                      cursor = null, limit = 100) {
+    try {
+      const params = { patient_id: patientId, limit };
+      if (allActivities.length) {
+        params.all_activities = allActivities.join(',');
+      }
+      if (anyActivities.length) {
+        params.any_activities = anyActivities.join(',');
+      }
+      if (cursor) {
+        params.cursor = cursor;
+      }
+      const response = await apiClient.get('/entries/query', { params });
+      return {
+        entries: response.data,
+        nextCursor: response.headers['x-next-cursor'] || null
+      };
+    } catch (error) {
+      console.error('Error querying entries by activity:', error);
+      throw error;
+    }
+  }
+
   static async getEntryByDate(date, patientId = 'default') {
     try {
       const response = await apiClient.get(`/entries/${date}`, {
@@ -100,9 +158,11 @@ class ApiService {
     }
   }
 
-  static async updateEntry(entryId, updateData) {
+  // Pass the entry's current version to get a 409 instead of overwriting a newer edit
+  static async updateEntry(entryId, updateData, version = null) {
     try {
-      const response = await apiClient.put(`/entries/${entryId}`, updateData);
+      const headers = version !== null ? { 'If-Match': `"${version}"` } : {};
+      const response = await apiClient.put(`/entries/${entryId}`, updateData, { headers });
       return response.data;
     } catch (error) {
       console.error(`Error updating entry ${entryId}:`, error);
@@ -133,17 +193,70 @@ class ApiService {
     }
   }
 
-  static async getMoodTrend(days = 90, patientId = 'default') {
+  // granularity 'week' or 'month' returns one aggregated row per period instead of per entry;
+  // maxPoints caps the number of rows, keeping peaks and dips
+  static async getMoodTrend(days = 90, patientId = 'default', granularity = 'day', maxPoints = null) {
     try {
-      const response = await apiClient.get('/stats/mood-trend', {
-        params: { days, patient_id: patientId }
-      });
+      const params = { days, patient_id: patientId, granularity };
+      if (maxPoints) {
+        params.max_points = maxPoints;
+      }
+      const response = await apiClient.get('/stats/mood-trend', { params });
       return response.data;
     } catch (error) {
       console.error('Error fetching mood trend:', error);
       throw error;
     }
   }
+
+  // Optional filters: { startDate, endDate, category }
+  static async getActivityFrequency(patientId = 'default', { startDate, endDate, category } = {}) {
+    try {
+      const params = { patient_id: patientId };
+      if (startDate) {
+        params.start_date = startDate;
+      }
+      if (endDate) {
+        params.end_date = endDate;
+      }
+      if (category) {
+        params.category = category;
+      }
+      const response = await apiClient.get('/stats/activity-frequency', { params });
+      return response.data;
+    } catch (error) {
+      console.error('Error fetching activity frequency:', error);
+      throw error;
+    }
+  }
+
+  // Pass an array of patient ids as cohort to pool their entries
+  static async getActivityImpact(patientId = 'default', { cohort, days } = {}) {
+    try {
+      const params = { patient_id: patientId };
+      if (cohort && cohort.length) {
+        params.cohort = cohort.join(',');
+      }
+      if (days) {
+        params.days = days;
+      }
+      const response = await apiClient.get('/stats/activity-impact', { params });
+      return response.data;
+    } catch (error) {
+      console.error('Error fetching activity impact:', error);
+      throw error;
+    }
+  }
+
+  // Push updates instead of polling: onEvent(type, data) fires for entry-changed and
+  // stats-changed. Returns a function that closes the connection.
+  static subscribeToEvents(onEvent, patientId = 'default') {
+    const source = new EventSource(`${API_BASE}/events?patient_id=${encodeURIComponent(patientId)}`);
+    ['entry-changed', 'stats-changed'].forEach((type) => {
+      source.addEventListener(type, (event) => onEvent(type, JSON.parse(event.data)));
+    });
+    return () => source.close();
+  }
 }
 
 export default ApiService;
\ No newline at end of file
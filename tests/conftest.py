@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "mood_tracker_test")
+# Tests that exercise the stats cache build their own instances
+os.environ["STATS_CACHE_BACKEND"] = "none"
+
+try:
+    # Swap in an in-memory MongoDB before database.py creates its client
+    import motor.motor_asyncio
+    from mongomock_motor import AsyncMongoMockClient
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    HAS_MONGOMOCK = True
+except ImportError:
+    HAS_MONGOMOCK = False
+
+
+@pytest.fixture
+def database():
+    """Empty in-memory database with the reference data loaded"""
+    if not HAS_MONGOMOCK:
+        pytest.skip("mongomock-motor is not installed")
+    import database
+
+    async def reset():
+        for name in await database.db.list_collection_names():
+            await database.db.drop_collection(name)
+        await database.init_reference_data()
+        await database.load_reference_cache()
+
+    asyncio.run(reset())
+    return database
+
+
+@pytest.fixture
+def api(database):
+    """Client for the HTTP API on an indexed, empty database (startup tasks are not run)"""
+    from fastapi.testclient import TestClient
+    import indexes
+    import server
+
+    asyncio.run(indexes.ensure_indexes())
+    return TestClient(server.app)
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import migrate
+from activity_mask import MAX_ACTIVITY_ID, mask_for_ids
+
+
+def test_mask_for_ids():
+    assert mask_for_ids([]) == 0
+    assert mask_for_ids([1, 3, 3]) == 0b1010
+    assert mask_for_ids([MAX_ACTIVITY_ID]) == 1 << MAX_ACTIVITY_ID
+
+
+@pytest.mark.parametrize("activity_id", [-1, MAX_ACTIVITY_ID + 1])
+def test_mask_for_ids_rejects_ids_outside_the_mask(activity_id):
+    with pytest.raises(ValueError):
+        mask_for_ids([activity_id])
+
+
+def test_background_migrations_backfill_masks(database):
+    async def main():
+        await database.mood_entries_collection.insert_many([
+            {"id": f"e{day}", "patient_id": "p", "date": f"2024-01-{day:02d}", "mood_id": 3,
+             "activity_ids": [day, 13], "updated_at": datetime(2024, 1, 1)}
+            for day in range(1, 4)
+        ])
+        migrate.start_background_migrations()
+        await migrate._background_migrations_task
+        return await database.mood_entries_collection.find({}, {"_id": 0, "id": 1, "activity_mask": 1}).to_list(None)
+
+    docs = asyncio.run(main())
+    assert sorted((doc["id"], doc["activity_mask"]) for doc in docs) == [
+        ("e1", mask_for_ids([1, 13])), ("e2", mask_for_ids([2, 13])), ("e3", mask_for_ids([3, 13]))
+    ]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from analytics import activity_effects, t_quantile
+
+
+@pytest.mark.parametrize("df, expected", [
+    (1, 12.7062), (2, 4.3027), (3, 3.1824), (5, 2.5706), (10, 2.2281), (30, 2.0423),
+])
+def test_t_quantile(df, expected):
+    assert float(t_quantile(np.array([df]))[0]) == pytest.approx(expected, abs=2e-3)
+
+
+def test_t_quantile_approaches_normal():
+    assert float(t_quantile(np.array([100000]))[0]) == pytest.approx(1.96, abs=1e-3)
+
+
+def test_activity_effects_matches_direct_computation():
+    rng = np.random.default_rng(7)
+    mood = rng.integers(1, 6, size=60).astype(float)
+    activities = rng.random((60, 3)) < 0.4
+    effects = activity_effects(mood, activities)
+
+    for column in range(3):
+        with_activity = mood[activities[:, column]]
+        without_activity = mood[~activities[:, column]]
+        assert effects["days_with"][column] == len(with_activity)
+        assert effects["days_without"][column] == len(without_activity)
+        assert effects["mean_with"][column] == pytest.approx(with_activity.mean())
+        assert effects["mean_without"][column] == pytest.approx(without_activity.mean())
+        assert effects["lift"][column] == pytest.approx(with_activity.mean() / without_activity.mean())
+
+        var_with = with_activity.var(ddof=1) / len(with_activity)
+        var_without = without_activity.var(ddof=1) / len(without_activity)
+        se = np.sqrt(var_with + var_without)
+        df = np.floor((var_with + var_without) ** 2 / (
+            var_with ** 2 / (len(with_activity) - 1) + var_without ** 2 / (len(without_activity) - 1)))
+        margin = float(t_quantile(np.array([df]))[0]) * se
+        difference = with_activity.mean() - without_activity.mean()
+        assert effects["ci_low"][column] == pytest.approx(difference - margin)
+        assert effects["ci_high"][column] == pytest.approx(difference + margin)
+
+
+def test_activity_effects_small_groups_widen_interval():
+    mood = np.array([5, 4, 5, 2, 3, 2, 3, 2, 3, 3], dtype=float)
+    activities = np.zeros((10, 1), dtype=bool)
+    activities[:3, 0] = True
+    effects = activity_effects(mood, activities)
+    normal_margin = 1.959964 * np.sqrt(mood[:3].var(ddof=1) / 3 + mood[3:].var(ddof=1) / 7)
+    assert effects["ci_high"][0] - effects["difference"][0] > normal_margin
+
+
+def test_activity_effects_undefined_without_variance():
+    mood = np.array([4, 2, 3], dtype=float)
+    activities = np.array([[True, False], [False, False], [False, True]])
+    effects = activity_effects(mood, activities)
+    # One entry with the activity: no variance, so no interval
+    assert np.isnan(effects["ci_low"][0])
+    assert effects["mean_with"][0] == 4
+    assert effects["mean_without"][0] == 2.5
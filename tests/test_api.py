@@ -0,0 +1,89 @@
+MOOD = {"id": 4, "name": "bene", "emoji": "😊", "color": "#6BCF7F"}
+
+
+def entry(day: str, **fields) -> dict:
+    return {"date": day, "mood": MOOD, **fields}
+
+
+def test_second_entry_for_a_day_is_rejected(api):
+    assert api.post("/api/entries", json=entry("2024-05-01")).status_code == 200
+    response = api.post("/api/entries", json=entry("2024-05-01"))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Entry already exists for date 2024-05-01"
+    # The constraint is per patient
+    assert api.post("/api/entries?patient_id=p2", json=entry("2024-05-01")).status_code == 200
+    assert len(api.get("/api/entries").json()) == 1
+
+
+def test_matching_if_none_match_answers_304(api):
+    api.post("/api/entries", json=entry("2024-05-01"))
+    first = api.get("/api/stats/overview")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert "Last-Modified" in first.headers
+
+    cached = api.get("/api/stats/overview", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+    assert cached.content == b""
+    # Weak comparison: a W/ prefix still matches
+    assert api.get("/api/stats/overview", headers={"If-None-Match": f"W/{etag}"}).status_code == 304
+
+    # A write changes the validator
+    api.post("/api/entries", json=entry("2024-05-02"))
+    changed = api.get("/api/stats/overview", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["total_entries"] == 2
+
+
+def test_reference_data_answers_304(api):
+    etag = api.get("/api/moods").headers["ETag"]
+    assert api.get("/api/moods", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_resaving_identical_values_succeeds(api):
+    created = api.post("/api/entries", json=entry("2024-05-01", note="same")).json()
+    response = api.put(f"/api/entries/{created['id']}", json={"note": "same"})
+    assert response.status_code == 200
+    assert response.json()["note"] == "same"
+    assert response.json()["id"] == created["id"]
+    assert api.put("/api/entries/missing", json={"note": "x"}).status_code == 404
+
+
+def test_stale_if_match_conflicts(api):
+    created = api.post("/api/entries", json=entry("2024-05-01")).json()
+    url = f"/api/entries/{created['id']}"
+    first = api.put(url, json={"note": "first"}, headers={"If-Match": '"1"'})
+    assert first.status_code == 200
+    assert first.headers["ETag"] == '"2"'
+
+    stale = api.put(url, json={"note": "second"}, headers={"If-Match": '"1"'})
+    assert stale.status_code == 409
+    assert api.get("/api/entries/2024-05-01").json()["note"] == "first"
+
+    # The body version works the same way
+    assert api.put(url, json={"note": "second", "version": 1}).status_code == 409
+
+
+def test_retry_of_an_applied_update_succeeds(api):
+    created = api.post("/api/entries", json=entry("2024-05-01")).json()
+    url = f"/api/entries/{created['id']}"
+    assert api.put(url, json={"note": "once"}, headers={"If-Match": '"1"'}).status_code == 200
+    retry = api.put(url, json={"note": "once"}, headers={"If-Match": '"1"'})
+    assert retry.status_code == 200
+    assert retry.json()["version"] == 2
+
+
+def test_if_match_forms(api):
+    created = api.post("/api/entries", json=entry("2024-05-01")).json()
+    url = f"/api/entries/{created['id']}"
+    assert api.put(url, json={"note": "a"}, headers={"If-Match": "*"}).status_code == 200
+    assert api.put(url, json={"note": "b"}, headers={"If-Match": 'W/"2"'}).status_code == 412
+    assert api.put(url, json={"note": "b"}, headers={"If-Match": '"abc"'}).status_code == 400
+
+
+def test_changes_limit_is_validated(api):
+    api.post("/api/entries", json=entry("2024-05-01"))
+    assert api.get("/api/entries/changes?limit=0").status_code == 422
+    assert api.get("/api/entries/changes?limit=1").status_code == 200
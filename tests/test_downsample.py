@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from downsample import lttb_indices, downsample_trend
+
+
+def test_lttb_keeps_endpoints_and_threshold_points():
+    x = np.arange(1000, dtype=float)
+    y = np.sin(x / 50)
+    indices = lttb_indices(x, y, 100)
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(500, dtype=float)
+    y = np.full(500, 3.0)
+    y[137], y[401] = 5.0, 1.0
+    indices = lttb_indices(x, y, 20)
+    assert 137 in indices
+    assert 401 in indices
+
+
+def test_lttb_returns_every_point_below_threshold():
+    x = np.arange(10, dtype=float)
+    assert list(lttb_indices(x, x, 10)) == list(range(10))
+    assert list(lttb_indices(x, x, 2)) == list(range(10))
+
+
+def test_downsample_trend():
+    start = date(2024, 1, 1)
+    rows = [{"date": (start + timedelta(days=i)).isoformat(), "mood": i % 5 + 1} for i in range(365)]
+    assert downsample_trend(rows, 400, "mood") is rows
+    sampled = downsample_trend(rows, 50, "mood")
+    assert len(sampled) == 50
+    assert sampled[0] is rows[0] and sampled[-1] is rows[-1]
+    assert [row["date"] for row in sampled] == sorted(row["date"] for row in sampled)
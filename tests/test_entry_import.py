@@ -0,0 +1,78 @@
+import asyncio
+
+from csv_export import CSV_HEADER, stream_mood_csv
+from entry_import import import_entries
+from indexes import ensure_indexes
+from models import CreateMoodEntryRequest
+from mood_service import MoodService
+
+MOODS = {
+    2: {"id": 2, "name": "male", "emoji": "😔", "color": "#FF8E53"},
+    4: {"id": 4, "name": "bene", "emoji": "😊", "color": "#6BCF7F"},
+}
+MEDITATION = {"id": 13, "name": "Meditazione", "icon": "🧘", "category": "Attività Terapeutiche"}
+READING = {"id": 21, "name": "Lettura", "icon": "📚", "category": "Crescita Personale"}
+
+
+async def export_csv(patient_id: str) -> str:
+    return b"".join([chunk async for chunk in stream_mood_csv(patient_id)]).decode("utf-8")
+
+
+def entry_fields(entry):
+    return (entry.date, entry.mood.id, [activity.id for activity in entry.activities], entry.note,
+            entry.created_at.replace(microsecond=0))
+
+
+def test_csv_export_round_trip(database):
+    async def main():
+        await ensure_indexes()
+        requests = [
+            CreateMoodEntryRequest(date="2024-05-01", mood=MOODS[4], activities=[MEDITATION, READING],
+                                   note="multi-line,\n\"quoted\" note"),
+            CreateMoodEntryRequest(date="2024-05-02", mood=MOODS[2]),
+            CreateMoodEntryRequest(date="2024-05-03", mood=MOODS[4], activities=[READING], note="ok"),
+        ]
+        for request in requests:
+            await MoodService.create_entry(request, "source")
+
+        text = await export_csv("source")
+        report = await import_entries(text, "csv", "copy")
+        assert (report.total_rows, report.imported, report.failed) == (3, 3, 0)
+
+        source = await MoodService.get_all_entries("source")
+        copy = await MoodService.get_all_entries("copy")
+        assert sorted(map(entry_fields, copy)) == sorted(map(entry_fields, source))
+        assert all(entry.patient_id == "copy" for entry in copy)
+
+        statistics = await MoodService.get_statistics("copy")
+        assert statistics.total_entries == 3
+
+        # Importing the same export again hits the one-entry-per-day constraint
+        again = await import_entries(text, "csv", "copy")
+        assert (again.imported, again.failed) == (0, 3)
+        assert again.errors[0].error.startswith("Entry already exists for date")
+    asyncio.run(main())
+
+
+def test_csv_import_reports_bad_rows(database):
+    async def main():
+        rows = [
+            ",".join(CSV_HEADER),
+            "2024-05-01,bene,4,😊,Meditazione (Attività Terapeutiche),,",
+            "2024-05-02,bene,9,😊,,,",
+            "2024-05-03,bene,4,😊,Volare (Sogni),,",
+            "2024-02-30,bene,4,😊,,,",
+            "2024-05-05,bene",
+        ]
+        report = await import_entries("\n".join(rows) + "\n", "csv", "p")
+        assert (report.total_rows, report.imported, report.failed) == (5, 1, 4)
+        assert [error.row for error in report.errors] == [3, 4, 5, 6]
+        assert report.errors[0].error == "Unknown mood level: 9"
+        assert report.errors[1].error == "Unknown activity: Volare (Sogni)"
+    asyncio.run(main())
+
+
+def test_csv_import_rejects_unexpected_header(database):
+    report = asyncio.run(import_entries("Date,Mood\n2024-05-01,4\n", "csv", "p"))
+    assert (report.imported, report.failed) == (0, 1)
+    assert report.errors[0].row == 1
@@ -0,0 +1,162 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import migrate
+from migrate import (MIGRATIONS, MigrationLeaseError, Quarantine, _activity_mask, _compact_storage,
+                     _native_date, _version, run_migration)
+
+REFERENCE = ({1: "molto male", 4: "bene"}, {13: "Meditazione", 21: "Lettura"})
+UPDATED_AT = datetime(2024, 1, 1)
+
+
+def legacy_entry(number: int, **fields) -> dict:
+    doc = {
+        "_id": number, "id": f"e{number}", "patient_id": "p", "date": f"2024-01-{number:02d}",
+        "mood": {"id": 4, "name": "bene"}, "activities": [{"id": 13, "name": "Meditazione"}],
+        "note": "", "updated_at": UPDATED_AT,
+    }
+    doc.update(fields)
+    return doc
+
+
+def test_compact_storage_transform():
+    assert _compact_storage(legacy_entry(1), REFERENCE) == {
+        "$unset": {"mood": "", "activities": ""},
+        "$set": {"mood_id": 4, "activity_ids": [13]},
+    }
+    # Already compacted fields win over the embedded copies
+    assert _compact_storage({"mood_id": 1, "mood": {"id": 4}}, REFERENCE) == {"$unset": {"mood": ""}}
+    duplicated = legacy_entry(1, activities=[{"id": 21}, {"id": 13}, {"id": 21}])
+    assert _compact_storage(duplicated, REFERENCE)["$set"]["activity_ids"] == [21, 13]
+
+
+def test_compact_storage_skips_unknown_reference_ids():
+    assert _compact_storage(legacy_entry(1, mood={"id": 99}), REFERENCE) is None
+    assert _compact_storage(legacy_entry(1, activities=[{"id": 99}]), REFERENCE) is None
+
+
+def test_activity_mask_transform():
+    assert _activity_mask({"activity_ids": [1, 3]}, REFERENCE) == {"$set": {"activity_mask": 0b1010}}
+    assert _activity_mask({"activities": [{"id": 2}]}, REFERENCE) == {"$set": {"activity_mask": 0b100}}
+    assert _activity_mask({"activity_ids": [63]}, REFERENCE) is None
+
+
+def test_version_transform():
+    assert _version({}, REFERENCE) == {"$set": {"version": 1}}
+
+
+def test_native_date_transform():
+    assert _native_date({"date": "2024-03-01"}, REFERENCE) == {"$set": {"day_number": 738946}}
+    assert _native_date({"date": "2024-02-30"}, REFERENCE) == Quarantine("Invalid date '2024-02-30'")
+    assert isinstance(_native_date({}, REFERENCE), Quarantine)
+
+
+def seed(database, docs):
+    asyncio.run(database.mood_entries_collection.insert_many(docs))
+
+
+def test_run_migration_resumes_from_checkpoint(database):
+    seed(database, [legacy_entry(number) for number in range(1, 8)])
+
+    first = asyncio.run(run_migration(MIGRATIONS["version"], batch_size=2, rate=10000, limit=3))
+    assert (first["processed"], first["modified"], first["last_id"]) == (3, 3, 3)
+    assert first["completed_at"] is None
+
+    second = asyncio.run(run_migration(MIGRATIONS["version"], batch_size=2, rate=10000))
+    assert (second["processed"], second["modified"], second["last_id"]) == (7, 7, 7)
+    assert second["completed_at"] is not None
+    # Resumed, not restarted (the stored time has millisecond precision)
+    assert abs(second["started_at"] - first["started_at"]) < timedelta(milliseconds=1)
+
+    async def check():
+        checkpoint = await database.migration_checkpoints_collection.find_one({"_id": "version"})
+        count = await database.mood_entries_collection.count_documents({"version": 1})
+        return checkpoint, count
+    checkpoint, count = asyncio.run(check())
+    assert count == 7
+    assert checkpoint["processed"] == 7
+    assert checkpoint["lease_owner"] is None
+
+    restarted = asyncio.run(run_migration(MIGRATIONS["version"], rate=10000, restart=True))
+    assert (restarted["processed"], restarted["modified"]) == (0, 0)
+
+
+def test_dry_run_writes_nothing(database):
+    seed(database, [legacy_entry(number) for number in range(1, 4)])
+    result = asyncio.run(run_migration(MIGRATIONS["version"], rate=10000, dry_run=True))
+    assert (result["processed"], result["modified"]) == (3, 3)
+
+    async def check():
+        return (await database.mood_entries_collection.count_documents({"version": 1}),
+                await database.migration_checkpoints_collection.count_documents({}))
+    assert asyncio.run(check()) == (0, 0)
+
+
+def test_lease_held_by_another_process(database):
+    seed(database, [legacy_entry(1)])
+
+    def hold_lease(until):
+        asyncio.run(database.migration_checkpoints_collection.replace_one(
+            {"_id": "version"}, {"lease_owner": "other:1:abc", "lease_until": until}, upsert=True
+        ))
+
+    hold_lease(datetime.utcnow() + timedelta(minutes=1))
+    with pytest.raises(MigrationLeaseError):
+        asyncio.run(run_migration(MIGRATIONS["version"], rate=10000))
+
+    # An expired lease is taken over
+    hold_lease(datetime.utcnow() - timedelta(minutes=1))
+    assert asyncio.run(run_migration(MIGRATIONS["version"], rate=10000))["modified"] == 1
+
+
+def test_unconvertible_documents_are_rescanned(database):
+    seed(database, [legacy_entry(1), legacy_entry(2, mood={"id": 99, "name": "?"}), legacy_entry(3)])
+
+    first = asyncio.run(run_migration(MIGRATIONS["compact-storage"], rate=10000))
+    assert (first["processed"], first["modified"], first["skipped"], first["remaining"]) == (3, 2, 1, 1)
+    assert first["last_id"] is None
+    assert first["completed_at"] is None
+
+    asyncio.run(database.mood_entries_collection.update_one({"_id": 2}, {"$set": {"mood.id": 1}}))
+    second = asyncio.run(run_migration(MIGRATIONS["compact-storage"], rate=10000))
+    assert (second["skipped"], second["remaining"]) == (0, 0)
+    assert second["completed_at"] is not None
+
+
+
+def test_native_date_quarantines_invalid_dates(database):
+    seed(database, [legacy_entry(1), legacy_entry(2, date="2024-02-30")])
+    result = asyncio.run(run_migration(MIGRATIONS["native-date"], rate=10000))
+    assert (result["modified"], result["quarantined"]) == (1, 1)
+
+    async def check():
+        return (await database.mood_entries_collection.find_one({"_id": 1}),
+                await database.mood_entries_collection.find_one({"_id": 2}),
+                await database.mood_entries_quarantine_collection.find_one({"_id": 2}),
+                await database.mood_entry_tombstones_collection.find_one({"id": "e2"}))
+    converted, removed, quarantined, tombstone = asyncio.run(check())
+    assert converted["day_number"] == 738886
+    assert removed is None
+    assert quarantined["quarantine_reason"] == "Invalid date '2024-02-30'"
+    assert tombstone["patient_id"] == "p"
+
+
+def test_background_migration_skips_a_completed_checkpoint(database, monkeypatch):
+    calls = []
+
+    async def spy(migration, **options):
+        calls.append(migration.name)
+        return await run_migration(migration, **options)
+    monkeypatch.setattr(migrate, "run_migration", spy)
+    seed(database, [legacy_entry(1)])
+
+    asyncio.run(migrate._run_background_migration("native-date"))
+    asyncio.run(migrate._run_background_migration("native-date"))
+    assert calls == ["native-date"]
+
+    # A checkpoint with entries left to convert is picked up again
+    asyncio.run(database.migration_checkpoints_collection.update_one({"_id": "native-date"}, {"$set": {"remaining": 1}}))
+    asyncio.run(migrate._run_background_migration("native-date"))
+    assert calls == ["native-date", "native-date"]
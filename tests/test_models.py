@@ -0,0 +1,23 @@
+from datetime import date
+
+import pytest
+from pydantic import ValidationError
+
+from models import CreateMoodEntryRequest, parse_entry_date
+
+
+def test_parse_entry_date():
+    assert parse_entry_date("2024-02-29") == date(2024, 2, 29)
+
+
+@pytest.mark.parametrize("value", ["2024-02-30", "2023-02-29", "20240101", "2024-1-01", "2024-01-01T00:00", "", None, 20240101])
+def test_parse_entry_date_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        parse_entry_date(value)
+
+
+def test_create_request_validates_date():
+    mood = {"id": 3, "name": "neutro", "emoji": "😐", "color": "#FFD23F"}
+    assert CreateMoodEntryRequest(date="2024-01-31", mood=mood).date == "2024-01-31"
+    with pytest.raises(ValidationError):
+        CreateMoodEntryRequest(date="2024-01-32", mood=mood)
@@ -0,0 +1,171 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import CreateMoodEntryRequest
+from mood_service import (MoodService, decode_cursor, decode_watermark, encode_cursor, encode_watermark,
+                          MAX_CHANGES_LIMIT)
+
+MOOD = {"id": 4, "name": "bene", "emoji": "😊", "color": "#6BCF7F"}
+
+
+async def create_entries(days, patient_id: str = "p", **fields):
+    return [
+        await MoodService.create_entry(CreateMoodEntryRequest(date=day, mood=MOOD, **fields), patient_id)
+        for day in days
+    ]
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("2024-03-01", "6f1c2a")
+    assert decode_cursor(cursor) == ("2024-03-01", "6f1c2a")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"{}").decode(),
+    base64.urlsafe_b64encode(b'["2024-03-01"]').decode(),
+    base64.urlsafe_b64encode(b'["2024-03-01", 5]').decode(),
+])
+def test_decode_cursor_rejects_malformed(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_entries_page_through_every_entry_once(database):
+    days = [f"2024-05-{day:02d}" for day in range(1, 8)]
+
+    async def main():
+        await create_entries(days)
+        await create_entries(["2024-05-04"], patient_id="other")
+        pages, cursor = [], None
+        while True:
+            entries, cursor = await MoodService.get_entries_page("p", 3, cursor)
+            pages.append([entry.date for entry in entries])
+            if cursor is None:
+                return pages
+
+    assert asyncio.run(main()) == [
+        ["2024-05-07", "2024-05-06", "2024-05-05"],
+        ["2024-05-04", "2024-05-03", "2024-05-02"],
+        ["2024-05-01"],
+    ]
+
+
+def test_watermark_round_trip_keeps_millisecond_precision():
+    timestamp = datetime(2024, 3, 1, 12, 30, 5, 123456)
+    decoded, entry_id = decode_watermark(encode_watermark(timestamp, "abc"))
+    assert decoded == datetime(2024, 3, 1, 12, 30, 5, 123000)
+    assert entry_id == "abc"
+
+
+@pytest.mark.parametrize("watermark", [
+    "%%%",
+    base64.urlsafe_b64encode(b"[]").decode(),
+    base64.urlsafe_b64encode(b'["soon", "abc"]').decode(),
+])
+def test_decode_watermark_rejects_malformed(watermark):
+    with pytest.raises(ValueError):
+        decode_watermark(watermark)
+
+
+def test_changes_page_through_updates_and_deletions(database):
+    # Fixed past timestamps keep the changes clear of the sync safety lag
+    base = (datetime.utcnow() - timedelta(hours=1)).replace(microsecond=0)
+
+    async def main():
+        entries = await create_entries(["2024-05-01", "2024-05-02", "2024-05-03", "2024-05-04"])
+        await create_entries(["2024-05-01"], patient_id="other")
+        for seconds, entry in enumerate(entries[:3], start=1):
+            await database.mood_entries_collection.update_one(
+                {"id": entry.id}, {"$set": {"updated_at": base + timedelta(seconds=seconds)}}
+            )
+        await MoodService.delete_entry(entries[3].id)
+        await database.mood_entry_tombstones_collection.update_one(
+            {"id": entries[3].id}, {"$set": {"deleted_at": base + timedelta(seconds=2.5)}}
+        )
+
+        snapshot = await MoodService.get_changes("p")
+        first = await MoodService.get_changes("p", encode_watermark(base), limit=2)
+        second = await MoodService.get_changes("p", first.watermark, limit=2)
+        third = await MoodService.get_changes("p", second.watermark, limit=2)
+        return [entry.id for entry in entries], snapshot, first, second, third
+
+    ids, snapshot, first, second, third = asyncio.run(main())
+    # A snapshot lists current entries only and starts the client over
+    assert snapshot.reset
+    assert sorted(entry.id for entry in snapshot.entries) == sorted(ids[:3])
+    assert snapshot.deleted == []
+
+    assert not first.reset and first.has_more
+    assert [entry.id for entry in first.entries] == ids[:2]
+    assert not second.has_more
+    assert [entry.id for entry in second.entries] == [ids[2]]
+    assert second.deleted == [ids[3]]
+    assert (third.entries, third.deleted, third.has_more) == ([], [], False)
+
+
+def test_changes_reset_after_the_tombstone_retention(database):
+    since = encode_watermark(datetime.utcnow() - timedelta(days=365))
+    assert asyncio.run(MoodService.get_changes("p", since)).reset
+
+
+@pytest.mark.parametrize("limit", [0, -1, MAX_CHANGES_LIMIT + 1])
+def test_changes_limit_out_of_range(database, limit):
+    with pytest.raises(ValueError):
+        asyncio.run(MoodService.get_changes("p", limit=limit))
+
+
+MEDITATION = {"id": 13, "name": "Meditazione", "icon": "🧘", "category": "Attività Terapeutiche"}
+READING = {"id": 21, "name": "Lettura", "icon": "📚", "category": "Crescita Personale"}
+
+
+def test_activity_frequency(database):
+    async def main():
+        await create_entries(["2024-05-01"], activities=[MEDITATION, READING])
+        await create_entries(["2024-05-02"], activities=[MEDITATION])
+        await create_entries(["2024-05-03"])
+        await create_entries(["2024-05-01"], patient_id="other", activities=[READING])
+        return (
+            await MoodService.get_activity_frequency("p"),
+            await MoodService.get_activity_frequency("p", start_date="2024-05-02"),
+            await MoodService.get_activity_frequency("p", "2024-05-01", "2024-05-01"),
+            await MoodService.get_activity_frequency("p", category="Crescita Personale"),
+            await MoodService.get_activity_frequency("unknown"),
+        )
+
+    unfiltered, since, one_day, category, unknown = asyncio.run(main())
+
+    def counts(frequencies):
+        return [(frequency.activity_name, frequency.count, frequency.percentage) for frequency in frequencies]
+
+    # Percentages are of the patient's entries in range, including those without activities
+    assert counts(unfiltered) == [("Meditazione", 2, 66.7), ("Lettura", 1, 33.3)]
+    assert counts(since) == [("Meditazione", 1, 50.0)]
+    assert counts(one_day) == [("Lettura", 1, 100.0), ("Meditazione", 1, 100.0)]
+    assert counts(category) == [("Lettura", 1, 33.3)]
+    assert unknown == []
+
+
+@pytest.mark.parametrize("start_date, end_date", [("2024-05-03", "2024-05-01"), ("2024-5-1", None)])
+def test_activity_frequency_rejects_bad_ranges(database, start_date, end_date):
+    with pytest.raises(ValueError):
+        asyncio.run(MoodService.get_activity_frequency("p", start_date, end_date))
+
+
+def test_create_entry_stores_reference_ids(database):
+    async def main():
+        stale = {**MOOD, "name": "x", "emoji": "?"}
+        entry = await MoodService.create_entry(
+            CreateMoodEntryRequest(date="2024-05-01", mood=stale, activities=[{**READING, "name": "x"}]), "p")
+        doc = await database.mood_entries_collection.find_one({"id": entry.id})
+        return entry, doc
+
+    entry, doc = asyncio.run(main())
+    assert (doc["mood_id"], doc["activity_ids"]) == (4, [21])
+    assert "mood" not in doc and "activities" not in doc
+    # Names and emojis come from the reference data, not from the request
+    assert (entry.mood.name, entry.mood.emoji) == ("bene", "😊")
+    assert entry.activities[0].name == "Lettura"
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from models import CreateMoodEntryRequest, UpdateMoodEntryRequest
+from mood_service import MoodService
+from patient_stats import _update_streak_anchor, current_streak, get_patient_stats, rebuild_patient_stats
+
+DAY = date(2024, 5, 20).toordinal()
+
+
+def test_current_streak():
+    stats = {"streak_start_day": DAY - 4, "streak_end_day": DAY}
+    assert current_streak(stats, date(2024, 5, 20)) == 5
+    # An entry for tomorrow (time zones ahead) still counts
+    assert current_streak(stats, date(2024, 5, 19)) == 5
+    assert current_streak(stats, date(2024, 5, 22)) == 0
+    assert current_streak({}, date(2024, 5, 20)) == 0
+
+
+def move_anchor(database, days, start, end, **change):
+    """Seed entries for `days` and a streak anchor, apply one change, and return the new anchor"""
+    async def main():
+        if days:
+            await database.mood_entries_collection.insert_many(
+                [{"patient_id": "p", "day_number": day} for day in days]
+            )
+        stats = {"_id": "p", "streak_start_day": start, "streak_end_day": end}
+        await database.patient_stats_collection.insert_one(dict(stats))
+        await _update_streak_anchor("p", stats, **change)
+        doc = await database.patient_stats_collection.find_one({"_id": "p"})
+        return doc["streak_start_day"], doc["streak_end_day"]
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("added_day, expected", [
+    (DAY + 1, (DAY - 2, DAY + 1)),  # extends the newest run
+    (DAY + 5, (DAY + 5, DAY + 5)),  # starts a new run after a gap
+    (DAY - 10, (DAY - 2, DAY)),     # older than the run, unchanged
+])
+def test_added_day_moves_anchor_without_scanning(database, added_day, expected):
+    assert move_anchor(database, [], DAY - 2, DAY, added_day=added_day) == expected
+
+
+def test_added_day_before_run_merges_with_older_run(database):
+    days = [DAY - 6, DAY - 5, DAY - 3, DAY - 2, DAY - 1, DAY, DAY - 4]
+    assert move_anchor(database, days, DAY - 3, DAY, added_day=DAY - 4) == (DAY - 6, DAY)
+
+
+def test_first_entry_sets_anchor(database):
+    assert move_anchor(database, [DAY], None, None, added_day=DAY) == (DAY, DAY)
+
+
+def test_removed_day_splits_run(database):
+    days = [DAY - 3, DAY - 2, DAY]
+    assert move_anchor(database, days, DAY - 3, DAY, removed_day=DAY - 1) == (DAY, DAY)
+
+
+def test_removed_newest_day_falls_back_to_older_run(database):
+    days = [DAY - 5, DAY - 4, DAY - 2, DAY - 1]
+    assert move_anchor(database, days, DAY - 2, DAY, removed_day=DAY) == (DAY - 2, DAY - 1)
+
+
+def test_removed_day_older_than_run_is_ignored(database):
+    assert move_anchor(database, [], DAY - 2, DAY, removed_day=DAY - 8) == (DAY - 2, DAY)
+
+
+def test_concurrent_anchor_move_triggers_rescan(database):
+    async def main():
+        await database.mood_entries_collection.insert_many(
+            [{"patient_id": "p", "day_number": day} for day in (DAY - 1, DAY, DAY + 1)]
+        )
+        await database.patient_stats_collection.insert_one(
+            {"_id": "p", "streak_start_day": DAY, "streak_end_day": DAY + 1}
+        )
+        # The caller read an anchor another writer has already moved
+        await _update_streak_anchor("p", {"streak_start_day": DAY, "streak_end_day": DAY}, added_day=DAY - 1)
+        return await database.patient_stats_collection.find_one({"_id": "p"})
+    doc = asyncio.run(main())
+    assert (doc["streak_start_day"], doc["streak_end_day"]) == (DAY - 1, DAY + 1)
+
+
+def counters(stats: dict) -> dict:
+    """The statistics fields that must agree between incremental updates and a rebuild"""
+    return {
+        "total_entries": stats["total_entries"],
+        "mood_sum": stats["mood_sum"],
+        "mood_counts": {key: value for key, value in stats["mood_counts"].items() if value},
+        "activity_counts": {key: value for key, value in stats["activity_counts"].items() if value},
+        "streak": (stats["streak_start_day"], stats["streak_end_day"]),
+    }
+
+
+def test_incremental_statistics_match_a_rebuild(database):
+    mood = {"id": 4, "name": "bene", "emoji": "😊", "color": "#6BCF7F"}
+    meditation = {"id": 13, "name": "Meditazione", "icon": "🧘", "category": "Attività Terapeutiche"}
+    reading = {"id": 21, "name": "Lettura", "icon": "📚", "category": "Crescita Personale"}
+
+    async def main():
+        entries = []
+        for day in ("2024-05-01", "2024-05-02", "2024-05-03", "2024-05-05"):
+            entries.append(await MoodService.create_entry(
+                CreateMoodEntryRequest(date=day, mood=mood, activities=[meditation]), "p"
+            ))
+        await MoodService.update_entry(entries[1].id, UpdateMoodEntryRequest(
+            mood={**mood, "id": 2, "name": "male"}, activities=[meditation, reading]
+        ))
+        await MoodService.delete_entry(entries[2].id)
+
+        incremental = await get_patient_stats("p")
+        rebuilt = await rebuild_patient_stats("p")
+        return incremental, rebuilt
+
+    incremental, rebuilt = asyncio.run(main())
+    assert counters(incremental) == counters(rebuilt)
+    assert counters(rebuilt)["total_entries"] == 3
+    assert counters(rebuilt)["mood_counts"] == {"2": 1, "4": 2}
+    assert counters(rebuilt)["activity_counts"] == {"13": 3, "21": 1}
+    assert counters(rebuilt)["streak"] == (date(2024, 5, 5).toordinal(), date(2024, 5, 5).toordinal())
@@ -0,0 +1,74 @@
+import asyncio
+from datetime import date
+
+from models import CreateMoodEntryRequest, UpdateMoodEntryRequest
+from mood_service import MoodService
+from rollups import get_rollups, period_start, rebuild_rollups
+
+MEDITATION = {"id": 13, "name": "Meditazione", "icon": "🧘", "category": "Attività Terapeutiche"}
+
+
+def mood(score: int) -> dict:
+    return {"id": score, "name": "x", "emoji": "x", "color": "x"}
+
+
+def test_period_start():
+    assert period_start(date(2024, 5, 16), "week") == date(2024, 5, 13)
+    assert period_start(date(2024, 5, 13), "week") == date(2024, 5, 13)
+    assert period_start(date(2024, 5, 16), "month") == date(2024, 5, 1)
+
+
+async def read_rollups(granularity: str):
+    return await get_rollups("p", granularity, date(2024, 1, 1), date(2024, 12, 31))
+
+
+def test_incremental_rollups_match_a_rebuild(database):
+    async def main():
+        created = {}
+        for day, score in [("2024-04-30", 2), ("2024-05-01", 4), ("2024-05-02", 5), ("2024-05-08", 3)]:
+            created[day] = await MoodService.create_entry(
+                CreateMoodEntryRequest(date=day, mood=mood(score), activities=[MEDITATION]), "p"
+            )
+        # First read builds the rollups; the writes after it update them incrementally
+        await read_rollups("week")
+        await MoodService.update_entry(created["2024-05-02"].id, UpdateMoodEntryRequest(mood=mood(1), activities=[]))
+        await MoodService.delete_entry(created["2024-05-08"].id)
+        await MoodService.create_entry(CreateMoodEntryRequest(date="2024-05-20", mood=mood(4)), "p")
+
+        incremental = {granularity: await read_rollups(granularity) for granularity in ("week", "month")}
+        assert await rebuild_rollups("p")
+        rebuilt = {granularity: await read_rollups(granularity) for granularity in ("week", "month")}
+        return incremental, rebuilt
+
+    incremental, rebuilt = asyncio.run(main())
+
+    def comparable(rollups):
+        return [
+            (rollup["period"], rollup["count"], rollup["mood_sum"],
+             {key: value for key, value in rollup.get("mood_counts", {}).items() if value},
+             {key: value for key, value in rollup.get("activity_counts", {}).items() if value})
+            for rollup in rollups
+        ]
+
+    assert comparable(incremental["week"]) == comparable(rebuilt["week"])
+    assert comparable(incremental["month"]) == comparable(rebuilt["month"])
+    # The week of 2024-05-06 lost its only entry and is no longer listed
+    assert comparable(rebuilt["week"]) == [
+        ("2024-04-29", 3, 7, {"2": 1, "4": 1, "1": 1}, {"13": 2}),
+        ("2024-05-20", 1, 4, {"4": 1}, {}),
+    ]
+    assert comparable(rebuilt["month"]) == [
+        ("2024-04-01", 1, 2, {"2": 1}, {"13": 1}),
+        ("2024-05-01", 3, 9, {"4": 2, "1": 1}, {"13": 1}),
+    ]
+
+
+def test_rollup_trend(database):
+    async def main():
+        for day, score in [("2024-05-01", 2), ("2024-05-02", 4)]:
+            await MoodService.create_entry(CreateMoodEntryRequest(date=day, mood=mood(score)), "p")
+        return await MoodService._compute_rollup_trend((date.today() - date(2024, 4, 1)).days, "p", "month")
+
+    assert asyncio.run(main()) == [
+        {"date": "2024-05-01", "count": 2, "mood_avg": 3.0, "mood_min": 2, "mood_max": 4, "activity_counts": {}}
+    ]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight, coalesce
+
+
+def test_concurrent_calls_share_one_execution():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"value": 1}
+
+        results = await asyncio.gather(*[flight.do("key", compute) for _ in range(5)])
+        other = await flight.do("other", compute)
+        return flight, calls, results, other
+
+    flight, calls, results, other = asyncio.run(main())
+    assert len(calls) == 2
+    assert all(result is results[0] for result in results)
+    assert other == {"value": 1}
+    assert flight.snapshot() == {"calls": 6, "executed": 2, "coalesced": 4, "in_flight": 0}
+
+
+def test_sequential_calls_execute_again():
+    async def main():
+        flight = SingleFlight()
+
+        async def compute():
+            return object()
+
+        return await flight.do("key", compute), await flight.do("key", compute)
+
+    first, second = asyncio.run(main())
+    assert first is not second
+
+
+def test_errors_reach_every_waiting_caller():
+    async def main():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        return await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [str(result) for result in results] == ["boom", "boom"]
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def main():
+        flight = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.02)
+            return 42
+
+        first = asyncio.ensure_future(flight.do("key", compute))
+        second = asyncio.ensure_future(flight.do("key", compute))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 42
+
+
+def test_coalesce_keys_on_bound_arguments_and_version():
+    calls = []
+    versions = {"p": 1}
+
+    async def version(arguments):
+        if arguments["data_version"] is None:
+            arguments["data_version"] = versions[arguments["patient_id"]]
+        return "reference"
+
+    @coalesce("test_read", version=version)
+    async def read(patient_id: str, days: int = 7, data_version: int = None):
+        calls.append((patient_id, days, data_version))
+        execution = len(calls)
+        await asyncio.sleep(0.01)
+        return execution
+
+    async def main():
+        # Positional, keyword and defaulted calls with the same values share one execution
+        shared = await asyncio.gather(read("p"), read("p", 7), read(patient_id="p", days=7), read("p", data_version=1))
+        versions["p"] = 2
+        after_write = await asyncio.gather(read("p"), read("p", days=30))
+        return shared, after_write
+
+    shared, after_write = asyncio.run(main())
+    assert shared == [1, 1, 1, 1]
+    assert sorted(after_write) == [2, 3]
+    assert calls[0] == ("p", 7, 1)
+    assert sorted(calls[1:]) == [("p", 7, 2), ("p", 30, 2)]
@@ -0,0 +1,213 @@
+import asyncio
+import json
+
+import pytest
+
+from stats_cache import MemoryCacheBackend, RedisCacheBackend, RedisError, StatsCache
+
+
+class RespServer:
+    """Local stand-in for a Redis server: RESP over TCP with strings, sets, GET/SET/SADD/SMEMBERS/DEL"""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        self.hang = False
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    async def _read_command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        arguments = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+        return arguments
+
+    async def _handle(self, reader, writer):
+        while True:
+            command = await self._read_command(reader)
+            if command is None:
+                break
+            if self.hang:
+                # A server that stopped answering without closing the connection
+                continue
+            writer.write(self._reply(command))
+            await writer.drain()
+        writer.close()
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _reply(self, command):
+        name, arguments = command[0].upper().decode(), command[1:]
+        self.commands.append((name, *arguments))
+        if name in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            return self._bulk(self.data.get(arguments[0]))
+        if name == "SET":
+            self.data[arguments[0]] = arguments[1]
+            return b"+OK\r\n"
+        if name == "SADD":
+            members = self.data.setdefault(arguments[0], set())
+            added = len(set(arguments[1:]) - members)
+            members.update(arguments[1:])
+            return b":%d\r\n" % added
+        if name == "PEXPIRE":
+            return b":%d\r\n" % (arguments[0] in self.data)
+        if name == "SMEMBERS":
+            members = self.data.get(arguments[0], set())
+            return b"*%d\r\n" % len(members) + b"".join(self._bulk(member) for member in members)
+        if name == "DEL":
+            deleted = sum(self.data.pop(key, None) is not None for key in arguments)
+            return b":%d\r\n" % deleted
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+
+def run_with_server(test):
+    async def main():
+        server = RespServer()
+        await server.start()
+        try:
+            await test(server)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+
+def test_redis_backend_get_set_invalidate():
+    async def test(server):
+        backend = RedisCacheBackend(f"redis://127.0.0.1:{server.port}")
+        assert await backend.get("missing") is None
+        await backend.set("p1", "k1", b"one", 60)
+        await backend.set("p1", "k2", b"two", 60)
+        await backend.set("p2", "k3", b"three", 60)
+        assert await backend.get("k1") == b"one"
+        assert ("SET", b"k1", b"one", b"PX", b"60000") in server.commands
+
+        await backend.invalidate("p1")
+        assert await backend.get("k1") is None
+        assert await backend.get("k2") is None
+        assert await backend.get("k3") == b"three"
+    run_with_server(test)
+
+
+def test_redis_backend_authenticates_and_selects_database():
+    async def test(server):
+        backend = RedisCacheBackend(f"redis://:secret@127.0.0.1:{server.port}/2")
+        await backend.get("k")
+        assert server.commands[:2] == [("AUTH", b"secret"), ("SELECT", b"2")]
+    run_with_server(test)
+
+
+def test_redis_backend_error_reply_keeps_connection_in_sync():
+    async def test(server):
+        backend = RedisCacheBackend(f"redis://127.0.0.1:{server.port}")
+        with pytest.raises(RedisError):
+            await backend._execute(("BOGUS",), ("SET", "k", "v"))
+        assert await backend.get("k") == b"v"
+    run_with_server(test)
+
+
+def test_stats_cache_reads_through_redis():
+    async def test(server):
+        cache = StatsCache(RedisCacheBackend(f"redis://127.0.0.1:{server.port}"), 60)
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return {"total": 3}
+
+        first = await cache.get_or_compute("p1", "statistics", {"days": 7}, 1, compute)
+        second = await cache.get_or_compute("p1", "statistics", {"days": 7}, 1, compute)
+        assert first == second == {"total": 3}
+        assert len(calls) == 1
+        assert cache.stats == {"hits": 1, "misses": 1, "errors": 0}
+
+        # A new data version is a different key
+        await cache.get_or_compute("p1", "statistics", {"days": 7}, 2, compute)
+        assert len(calls) == 2
+    run_with_server(test)
+
+
+def test_stats_cache_computes_when_redis_is_down():
+    async def main():
+        server = RespServer()
+        await server.start()
+        await server.stop()
+        cache = StatsCache(RedisCacheBackend(f"redis://127.0.0.1:{server.port}"), 60)
+
+        async def compute():
+            return [1, 2]
+
+        assert await cache.get_or_compute("p1", "trend", {}, 1, compute) == [1, 2]
+        await cache.invalidate("p1")
+        assert cache.stats == {"hits": 0, "misses": 1, "errors": 3}
+    asyncio.run(main())
+
+
+def test_stats_cache_computes_when_redis_hangs():
+    async def test(server):
+        cache = StatsCache(RedisCacheBackend(f"redis://127.0.0.1:{server.port}", timeout=0.05), 60)
+
+        async def compute():
+            return {"total": 1}
+
+        server.hang = True
+        started = asyncio.get_running_loop().time()
+        assert await cache.get_or_compute("p1", "statistics", {}, 1, compute) == {"total": 1}
+        await cache.invalidate("p1")
+        assert asyncio.get_running_loop().time() - started < 1
+        assert cache.stats["errors"] == 3
+
+        # The hung connection was dropped, so nothing stale is read once the server answers again
+        server.hang = False
+        await cache.get_or_compute("p1", "statistics", {}, 1, compute)
+        assert await cache.get_or_compute("p1", "statistics", {}, 1, compute) == {"total": 1}
+        assert cache.stats["hits"] == 1
+    run_with_server(test)
+
+
+def test_memory_backend_evicts_least_recently_used_by_size():
+    async def main():
+        backend = MemoryCacheBackend(max_bytes=10)
+        await backend.set("p1", "a", b"1234", 60)
+        await backend.set("p1", "b", b"1234", 60)
+        await backend.get("a")
+        await backend.set("p2", "c", b"1234", 60)
+        assert backend.size == 8
+        assert await backend.get("b") is None
+        assert await backend.get("a") == b"1234"
+
+        await backend.set("p2", "huge", b"x" * 11, 60)
+        assert await backend.get("huge") is None
+
+        await backend.invalidate("p1")
+        assert await backend.get("a") is None
+        assert await backend.get("c") == b"1234"
+        assert backend.size == 4
+    asyncio.run(main())
+
+
+def test_memory_backend_expires_entries():
+    async def main():
+        backend = MemoryCacheBackend(max_bytes=100)
+        await backend.set("p1", "a", json.dumps([1]).encode(), -1)
+        assert await backend.get("a") is None
+        assert backend.size == 0
+    asyncio.run(main())